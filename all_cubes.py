@@ -1,14 +1,19 @@
 import os
 import sys
+import json
+import time
 import argh
-import requests
+import tempfile
 import decorator
+import functools
+import threading
+import traceback
+import subprocess
 
-from subprocess import check_call
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
-from bs4 import BeautifulSoup
-
-from cubetoolkit import functions as ctk_functions
+from cubetoolkit import functions as ctk_functions, read_json_cache, write_json_cache, get_http_session
+from cubetoolkit import span, traced, take_trace_events, add_trace_events, print_trace_timings, write_trace
 
 
 CUBE_LIST_URL = "https://www.cubicweb.org/project?__fromnavigation=1&__force_display=1&vid=sameetypelist"
@@ -24,13 +29,34 @@ CUBES_SKIP = (
     'bookreader', 'externalauth', 'sitemaps', 'meeting'
 )
 
-# update
-# shell
-# all other commands of cubtk
+CUBE_LIST_CACHE_NAME = "cube_list.json"
+# written in the directory of the cubes by 'pull', contains the tip of each cube
+WORKSPACE_STATE_NAME = ".all-cubes.json"
 
+# can be modified using the global options of all-cubes
+settings = {
+    "jobs": 1,
+    "cube_list_ttl": 24 * 60 * 60,
+    "offline": False,
+    "refresh": False,
+}
 
-def list_cube():
-    soup = BeautifulSoup(requests.get(CUBE_LIST_URL).content, features="html.parser")
+# used to avoid mixing lines when several cubes are printing at the same time
+print_lock = threading.Lock()
+
+
+def parse_cube_list(content):
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    try:
+        import lxml  # noqa
+        html_parser = "lxml"
+    except ImportError:
+        html_parser = "html.parser"
+
+    # only build the tree of the part of the page listing the cubes
+    soup = BeautifulSoup(content, features=html_parser,
+                         parse_only=SoupStrainer("div", id="contentmain"))
 
     cubes = []
 
@@ -38,37 +64,85 @@ def list_cube():
         if not i.h3.text.startswith("cubicweb-"):
             continue
 
-        cube = i.h3.text.split('-', 1)[1]
+        cubes.append(i.h3.text.split('-', 1)[1])
 
-        if cube in CUBES_SKIP:
-            continue
+    return cubes
+
+
+def list_cube():
+    return [cube for cube in _get_cube_list() if cube not in CUBES_SKIP]
+
+
+@traced("cube list")
+def _get_cube_list():
+    cache = read_json_cache(CUBE_LIST_CACHE_NAME)
+
+    if cache and settings["offline"]:
+        return cache["cubes"]
+
+    if cache and not settings["refresh"] and time.time() - cache["date"] < settings["cube_list_ttl"]:
+        return cache["cubes"]
+
+    if settings["offline"]:
+        print("Error: offline mode but the cube list isn't in the cache")
+        print("Run any all-cubes command without '--offline' to fill it")
+        sys.exit(1)
+
+    import requests
+
+    try:
+        response = get_http_session().get(CUBE_LIST_URL, timeout=30)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        if not cache:
+            print("Error: couldn't download the cube list: %s" % e)
+            sys.exit(1)
+
+        print("Warning: couldn't download the cube list (%s), use the cached one" % e)
+        return cache["cubes"]
+
+    cubes = parse_cube_list(response.content)
 
-        cubes.append(cube)
+    write_json_cache(CUBE_LIST_CACHE_NAME, {"date": time.time(), "cubes": cubes})
 
     return cubes
 
 
-def clone():
-    cubes = list_cube()
+@traced("shell")
+def _run_shell_command(command, cwd=None, capture=True, prefix=None):
+    """ Run a shell command, returns its return code, its output and its duration.
 
-    for cube in cubes:
-        if os.path.exists(cube):
-            print("Skip %s, already cloned" % cube)
-            continue
+    If prefix is given, the output lines are also printed as soon as they are
+    produced, prefixed by '[prefix] '. """
+    start = time.time()
 
-        if cube in SPECIAL_CASES_CUBE_URL:
-            clone_command = SPECIAL_CASES_CUBE_URL[cube]
-        else:
-            clone_command = HG_CLONE_PATTERN % (cube, cube)
+    if not capture:
+        return_code = subprocess.call(command, cwd=cwd, shell=True)
+        return return_code, "", time.time() - start
 
-        print("Clone %s cube" % cube)
-        check_call(clone_command, shell=True)
+    process = subprocess.Popen(command, cwd=cwd, shell=True,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
 
+    output = []
+    for line in iter(process.stdout.readline, b""):
+        line = line.decode("utf-8", "replace")
+        output.append(line)
 
-@argh.named("exec")
-def exec_command(command):
+        if prefix is not None:
+            with print_lock:
+                sys.stdout.write("[%s] %s" % (prefix, line))
+                sys.stdout.flush()
+
+    process.stdout.close()
+    process.wait()
+
+    return process.returncode, "".join(output), time.time() - start
+
+
+def _get_present_cubes(pwd):
+    """ Returns the cubes that are cloned in pwd, exit if there isn't any. """
     cubes = list_cube()
-    pwd = os.path.realpath(os.path.curdir)
 
     cubes_in_dir = any([os.path.exists(os.path.join(pwd, cube)) for cube in cubes])
 
@@ -77,6 +151,8 @@ def exec_command(command):
         print("Download them using 'all-cubes clone'")
         sys.exit(1)
 
+    present_cubes = []
+
     for cube in cubes:
         path = os.path.join(pwd, cube)
 
@@ -84,45 +160,384 @@ def exec_command(command):
             print("Warning: cube '%s' dir isn't present, skip it" % cube)
             continue
 
-        print("Run '%s' in %s cube" % (command, cube))
-        print("======================================")
-        check_call(command, cwd=path, shell=True)
-        print("")
+        present_cubes.append(cube)
+
+    return present_cubes
+
+
+def _run_on_cubes(function, cubes, jobs=1, processes=False):
+    """ Call function(cube) for each cube using a pool of 'jobs' workers,
+    yields (cube, result) as soon as each call is finished.
+
+    Workers are threads unless processes is True, in this case function and
+    its result need to be picklable. """
+    if jobs <= 1:
+        for cube in cubes:
+            yield cube, function(cube)
+        return
+
+    if processes:
+        # forked workers inherit the spans already recorded by the parent,
+        # drop them so they aren't sent back and counted twice
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=take_trace_events)
+    else:
+        executor = ThreadPoolExecutor(max_workers=jobs)
+
+    futures = {executor.submit(function, cube): cube for cube in cubes}
+
+    try:
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # if the caller stops early, don't start the remaining cubes
+        for future in futures:
+            future.cancel()
+
+        executor.shutdown()
+
+
+def _print_results_table(results):
+    """ Print a table of (cube, return code, duration), exit if any has failed. """
+    cube_column_width = max([len("cube")] + [len(cube) for cube, _, _ in results])
+    print("%s  exit code  duration" % "cube".ljust(cube_column_width))
+
+    for cube, return_code, duration in results:
+        print("%s  %s  %7.1fs" % (cube.ljust(cube_column_width), str(return_code).rjust(9), duration))
+
+    failures = [cube for cube, return_code, _ in results if return_code != 0]
+
+    if failures:
         print("")
+        print("Failed in %s cubes: %s" % (len(failures), ", ".join(failures)))
+        sys.exit(1)
 
 
-def _wrap(function, *args, **kwargs):
+@argh.arg("-j", "--jobs", type=int, help="number of cubes cloned at the same time (default: global --jobs)")
+def clone(jobs=None):
     cubes = list_cube()
-    pwd = os.path.realpath(os.path.curdir)
+    jobs = jobs or settings["jobs"]
 
-    cubes_in_dir = any([os.path.exists(os.path.join(pwd, cube)) for cube in cubes])
+    summary = {
+        "cloned": [],
+        "skipped": [],
+        "failed": [],
+    }
 
-    if not cubes_in_dir:
-        print("Error: no cubes in current dirs")
-        print("Download them using 'all-cubes clone'")
-        sys.exit(1)
+    to_clone = []
 
     for cube in cubes:
-        path = os.path.join(pwd, cube)
+        if os.path.exists(cube):
+            print("Skip %s, already cloned" % cube)
+            summary["skipped"].append(cube)
+            continue
 
-        if not os.path.exists(path):
-            print("Warning: cube '%s' dir isn't present, skip it" % cube)
+        to_clone.append(cube)
+
+    def clone_cube(cube):
+        if cube in SPECIAL_CASES_CUBE_URL:
+            clone_command = SPECIAL_CASES_CUBE_URL[cube]
+        else:
+            clone_command = HG_CLONE_PATTERN % (cube, cube)
+
+        if jobs <= 1:
+            print("Clone %s cube" % cube)
+
+        # with several workers output is buffered per cube to avoid mixing them
+        return _run_shell_command(clone_command, capture=jobs > 1)
+
+    for cube, (return_code, output, duration) in _run_on_cubes(clone_cube, to_clone, jobs):
+        if jobs > 1:
+            print("Clone %s cube (%.1fs)" % (cube, duration))
+            print("======================================")
+            sys.stdout.write(output)
+            print("")
+
+        if return_code == 0:
+            summary["cloned"].append(cube)
+        else:
+            print("Error: failed to clone %s cube (return code: %s)" % (cube, return_code))
+            summary["failed"].append(cube)
+
+    print("")
+    print("Summary of execution")
+    print("====================")
+    print("")
+    print("Cloned cubes (%s): %s" % (len(summary["cloned"]), ", ".join(sorted(summary["cloned"]))))
+    print("Skipped cubes (%s): %s" % (len(summary["skipped"]), ", ".join(sorted(summary["skipped"]))))
+    print("Failed cubes (%s): %s" % (len(summary["failed"]), ", ".join(sorted(summary["failed"]))))
+    print_trace_timings()
+
+    if summary["failed"]:
+        sys.exit(1)
+
+
+def read_workspace_state(pwd):
+    """ Returns the state of the cubes of pwd written by the last 'pull':
+    {"cubes": {cube: {"tip": node, "previous_tip": node, "incoming": number, "date": timestamp}}} """
+    path = os.path.join(pwd, WORKSPACE_STATE_NAME)
+
+    if not os.path.exists(path):
+        return {"cubes": {}}
+
+    try:
+        with open(path, "r") as state_file:
+            return json.load(state_file)
+    except ValueError:
+        print("Warning: %s is corrupted, ignore it" % path)
+        return {"cubes": {}}
+
+
+def write_workspace_state(pwd, state):
+    path = os.path.join(pwd, WORKSPACE_STATE_NAME)
+    temporary_path = "%s.%s.tmp" % (path, os.getpid())
+
+    with open(temporary_path, "w") as state_file:
+        json.dump(state, state_file, indent=4, sort_keys=True)
+
+    os.rename(temporary_path, path)
+
+
+def _get_tip(path):
+    """ Returns (revision number, node) of the tip of the repository, or
+    (None, None) if it can't be read. """
+    return_code, output, _ = _run_shell_command('hg log -r tip -T "{rev} {node}"', cwd=path)
+
+    if return_code != 0:
+        return None, None
+
+    revision, node = output.split()
+
+    return int(revision), node
+
+
+@argh.arg("-j", "--jobs", type=int, help="number of cubes pulled at the same time (default: global --jobs)")
+def pull(jobs=None):
+    "Pull and update all the cubes, the new tip of each cube is recorded for 'exec --changed'"
+    pwd = os.path.realpath(os.path.curdir)
+    present_cubes = _get_present_cubes(pwd)
+    jobs = jobs or settings["jobs"]
+
+    def pull_cube(cube):
+        path = os.path.join(pwd, cube)
+        previous_revision, previous_tip = _get_tip(path)
+        return_code, output, duration = _run_shell_command("hg pull -u", cwd=path)
+        revision, tip = _get_tip(path)
+
+        # pulled changesets are appended to the repository
+        incoming = revision - previous_revision if None not in (revision, previous_revision) else None
+
+        return return_code, output, duration, previous_tip, tip, incoming
+
+    state = read_workspace_state(pwd)
+
+    summary = {
+        "updated": [],
+        "unchanged": [],
+        "failed": [],
+    }
+
+    for cube, (return_code, output, duration, previous_tip, tip, incoming) in _run_on_cubes(pull_cube, present_cubes, jobs):
+        if return_code != 0:
+            print("Error: failed to pull %s cube (return code: %s)" % (cube, return_code))
+            print("======================================")
+            sys.stdout.write(output)
+            print("")
+            summary["failed"].append(cube)
             continue
 
-        os.chdir(path)
+        print("Pull %s cube: %s new changesets (%.1fs)" % (cube, incoming, duration))
+
+        state["cubes"][cube] = {
+            "tip": tip,
+            "previous_tip": previous_tip,
+            "incoming": incoming,
+            "date": time.time(),
+        }
+
+        if incoming:
+            summary["updated"].append("%s (%s)" % (cube, incoming))
+        else:
+            summary["unchanged"].append(cube)
+
+    write_workspace_state(pwd, state)
+
+    print("")
+    print("Summary of execution")
+    print("====================")
+    print("")
+    print("Updated cubes (%s): %s" % (len(summary["updated"]), ", ".join(sorted(summary["updated"]))))
+    print("Unchanged cubes (%s): %s" % (len(summary["unchanged"]), ", ".join(sorted(summary["unchanged"]))))
+    print("Failed cubes (%s): %s" % (len(summary["failed"]), ", ".join(sorted(summary["failed"]))))
+    print_trace_timings()
+
+    if summary["failed"]:
+        sys.exit(1)
+
+
+@argh.arg("-j", "--jobs", type=int, help="number of cubes where the command is run at the same time (default: global --jobs)")
+@argh.arg("-k", "--keep-going", help="don't stop at the first cube where the command fails")
+@argh.arg("-p", "--prefix", help="stream output lines prefixed by the cube name instead of grouping them by cube")
+@argh.arg("-c", "--changed", help="only run the command in the cubes where the last 'pull' brought new changesets")
+@argh.named("exec")
+def exec_command(command, jobs=None, keep_going=False, prefix=False, changed=False):
+    pwd = os.path.realpath(os.path.curdir)
+    present_cubes = _get_present_cubes(pwd)
+    jobs = jobs or settings["jobs"]
+
+    if changed:
+        state = read_workspace_state(pwd)
+        present_cubes = [cube for cube in present_cubes if state["cubes"].get(cube, {}).get("incoming")]
+
+        if not present_cubes:
+            print("No cube has changed during the last 'all-cubes pull'")
+            return
+
+    # serial and not prefixed: let the command write directly on the terminal
+    live_output = jobs <= 1 and not prefix
+
+    def exec_in_cube(cube):
+        if live_output:
+            print("Run '%s' in %s cube" % (command, cube))
+            print("======================================")
+
+        return _run_shell_command(command, cwd=os.path.join(pwd, cube),
+                                  capture=not live_output,
+                                  prefix=cube if prefix else None)
+
+    results = []
+
+    for cube, (return_code, output, duration) in _run_on_cubes(exec_in_cube, present_cubes, jobs):
+        if not live_output and not prefix:
+            print("Run '%s' in %s cube" % (command, cube))
+            print("======================================")
+            sys.stdout.write(output)
+
+        if not prefix:
+            print("")
+            print("")
+
+        results.append((cube, return_code, duration))
+
+        if return_code != 0 and not keep_going:
+            print("Error: '%s' failed in %s cube (return code: %s), stop" % (command, cube, return_code))
+            break
+
+    print("")
+    print("Summary of execution")
+    print("====================")
+    print("")
+
+    if len(results) < len(present_cubes):
+        print("Stopped after %s on %s cubes" % (len(results), len(present_cubes)))
+        print("")
+
+    results.sort(key=lambda x: present_cubes.index(x[0]))
+    print_trace_timings()
+    print("")
+    _print_results_table(results)
+
+
+def _call_in_cube(function, pwd, args, kwargs, capture, cube):
+    """ Call function in the cube directory and returns its exit code, its
+    traceback if it raised, its output if captured, its duration and the
+    spans recorded in a worker process.
+
+    When capturing, the process file descriptors are redirected so the
+    output of subprocesses is captured too: only do it in worker processes. """
+    start = time.time()
+    exit_code = 0
+    error = None
+
+    if capture:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        output_file = tempfile.TemporaryFile()
+        saved_fds = os.dup(1), os.dup(2)
+        os.dup2(output_file.fileno(), 1)
+        os.dup2(output_file.fileno(), 2)
+
+    try:
+        os.chdir(os.path.join(pwd, cube))
+
+        with span(cube, "cube", function=function.__name__):
+            function(*args, **kwargs)
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            exit_code = e.code
+        elif e.code is not None:
+            print(e.code)
+            exit_code = 1
+    except Exception:
+        exit_code = 1
+        error = traceback.format_exc()
+    finally:
+        output = ""
+
+        if capture:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            os.close(saved_fds[0])
+            os.close(saved_fds[1])
+            output_file.seek(0)
+            output = output_file.read().decode("utf-8", "replace")
+            output_file.close()
+
+    return exit_code, error, output, time.time() - start, take_trace_events() if capture else []
+
+
+def _wrap(function, *args, **kwargs):
+    pwd = os.path.realpath(os.path.curdir)
+    present_cubes = _get_present_cubes(pwd)
+    jobs = settings["jobs"]
+
+    if jobs > 1:
+        # each cube is processed in its own worker process with its own cwd
+        process_cube = functools.partial(_call_in_cube, function, pwd, args, kwargs, True)
+    else:
+        def process_cube(cube):
+            print("Process cube '%s'" % (cube))
+            print("=======================")
+
+            return _call_in_cube(function, pwd, args, kwargs, False, cube)
+
+    results = []
+
+    for cube, (exit_code, error, output, duration, trace_events) in _run_on_cubes(process_cube, present_cubes, jobs, processes=True):
+        add_trace_events(trace_events)
+
+        if jobs > 1:
+            print("Process cube '%s'" % (cube))
+            print("=======================")
+            sys.stdout.write(output)
+
+        if error:
+            print(error)
 
-        print("Process cube '%s'" % (cube))
-        print("=======================")
-        function(*args, **kwargs)
         print("")
         print("")
 
+        results.append((cube, exit_code, duration))
+
+    os.chdir(pwd)
+
+    print("")
+    print("Summary of execution")
+    print("====================")
+    print("")
+
+    results.sort(key=lambda x: present_cubes.index(x[0]))
+    print_trace_timings()
+    print("")
+    _print_results_table(results)
+
 
 def on_all_cubes(function):
     return decorator.decorate(function, _wrap)
 
 
-functions = [clone, exec_command]
+functions = [clone, pull, exec_command]
 
 for function in ctk_functions:
     function_name = function.__name__
@@ -133,11 +548,33 @@ for function in ctk_functions:
     functions.append(wrapped_function)
 
 parser = argh.ArghParser()
+parser.add_argument("-j", "--jobs", type=int, default=settings["jobs"], dest="global_jobs",
+                    help="number of cubes processed at the same time, cubetoolkit commands are run in worker processes")
+parser.add_argument("--offline", action="store_true", default=False, dest="global_offline",
+                    help="only use the cached cube list, never download it")
+parser.add_argument("--refresh", action="store_true", default=False,
+                    help="download the cube list even if the cached one is still valid")
+parser.add_argument("--cube-list-ttl", type=int, default=settings["cube_list_ttl"],
+                    help="number of seconds the cached cube list stays valid")
+parser.add_argument("--trace", default=None, metavar="FILE",
+                    help="write the duration of each phase of the command in FILE in the chrome trace format")
 parser.add_commands(functions)
 
 
 def main():
-    parser.dispatch()
+    options = parser.parse_known_args()[0]
+
+    settings["jobs"] = options.global_jobs
+    settings["offline"] = options.global_offline
+    settings["refresh"] = options.refresh
+    settings["cube_list_ttl"] = options.cube_list_ttl
+
+    try:
+        with span(getattr(options, "function", main).__name__, "command"):
+            parser.dispatch()
+    finally:
+        if options.trace:
+            write_trace(options.trace)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,225 @@
+# pylint: disable=W0622
+# copyright 2003-2026 LOGILAB S.A. (Paris, FRANCE), all rights reserved.
+# contact http://www.logilab.fr/ -- mailto:contact@logilab.fr
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+"""cubicweb-benchmark application packaging information"""
+
+
+modname = 'cubicweb_benchmark'
+distname = 'cubicweb-benchmark'
+
+numversion = (2, 4, 0)
+version = '.'.join(str(num) for num in numversion)
+
+license = 'LGPL'
+author = 'LOGILAB S.A. (Paris, FRANCE)'
+author_email = 'contact@logilab.fr'
+description = 'a cube with a lot of dependencies, used by the benchmarks'
+web = 'http://www.cubicweb.org/project/%s' % distname
+
+__depends__ = {
+    'cubicweb': '>= 3.24.0, < 3.27.0',
+    'six': '< 1.2.1',
+    'lxml': '>= 3.17.4',
+    'setuptools': '>= 40.0.0',
+    'django': "== 1.11.29",
+    'requests': ">= 2.25.4",
+    'pyramid': '== 1.9.4',
+    'psycopg2': '>= 0.27.9, < 2.21.6',
+    'logilab-common': '>= 1.5.3, != 3.8.1',
+    'logilab-database': '>= 2.0.4, != 4.22.4',
+    'yams': ">= 1.13.6, != 4.9.6",
+    'rql': '< 1.7.4',  # see the changelog before upgrading
+    'docutils': '>= 0.2.0, < 3.20.4',
+    'markdown': '>= 4.20.7, != 2.4.3',
+    'pillow': '>= 3.29.3',
+    'python-dateutil': "< 2.5.5",
+    'pytz': '< 4.10.8',
+    'rdflib': None,
+    'simplejson': '== 2.24.9',
+    'jinja2': '>= 1.3.5, != 1.9.7',
+    'babel': ">= 0.11.1",
+    'html5lib': '>= 2.0.5, < 2.10.2',
+    'webtest': '< 4.21.1',  # see the changelog before upgrading
+    'sqlalchemy': '>= 4.6.7, < 2.4.4',
+    'celery': '< 4.30.2',
+    'redis': ">= 4.0.5, < 0.14.2",
+    'elasticsearch': '>= 2.9.9, < 0.14.3',
+    'passlib': '< 1.3.0',
+    'cryptography': '>= 0.23.2',
+    'pyyaml': '>= 1.19.0, != 4.15.9',
+    'cubicweb-accidents': "== 2.1.1",
+    'cubicweb-activitystream': '>= 2.24.6, != 1.15.3',
+    'cubicweb-addressbook': '== 3.13.7',
+    'cubicweb-api': '>= 1.13.7',  # see the changelog before upgrading
+    'cubicweb-apycot': None,
+    'cubicweb-awstats': "< 1.1.0",
+    'cubicweb-basket': '>= 2.7.8, < 1.24.3',
+    'cubicweb-blog': '< 2.4.5',
+    'cubicweb-book': '>= 2.18.1',
+    'cubicweb-bootstrap': '>= 3.30.0, != 3.12.1',
+    'cubicweb-brainomics': "< 1.29.9",
+    'cubicweb-calendar': '== 2.9.7',
+    'cubicweb-card': '>= 3.16.3, < 2.10.6',
+    'cubicweb-celery': '< 0.27.4',
+    'cubicweb-celerytask': '== 0.12.9',  # see the changelog before upgrading
+    'cubicweb-ckanpublish': "== 2.21.0",
+    'cubicweb-ckeditor': '== 3.18.7',
+    'cubicweb-clinipath': '< 3.6.0',
+    'cubicweb-cmcicpay': '== 1.0.9',
+    'cubicweb-cmt': '>= 0.12.6, < 1.17.0',
+    'cubicweb-codenaf': "== 1.21.9",
+    'cubicweb-collaboration': None,
+    'cubicweb-comment': '>= 0.22.9',
+    'cubicweb-company': '>= 3.17.4',
+    'cubicweb-compound': '>= 1.1.5, != 0.24.8',
+    'cubicweb-condor': ">= 2.26.5",  # see the changelog before upgrading
+    'cubicweb-conference': '>= 0.30.8',
+    'cubicweb-container': '< 3.6.4',
+    'cubicweb-counters': '< 1.24.7',
+    'cubicweb-datacat': '< 0.2.1',
+    'cubicweb-dataio': ">= 2.16.6, != 3.27.7",
+    'cubicweb-dataprocessing': '>= 1.20.4',
+    'cubicweb-dbpedia': '< 3.3.8',
+    'cubicweb-document': '== 2.27.2',
+    'cubicweb-drh': '== 1.10.7',
+    'cubicweb-eac': ">= 2.17.0, < 1.0.4",
+    'cubicweb-editorjs': '>= 4.3.7',  # see the changelog before upgrading
+    'cubicweb-elasticsearch': '>= 3.16.1, != 4.7.6',
+    'cubicweb-elections': None,
+    'cubicweb-email': '>= 2.17.7, != 4.9.8',
+    'cubicweb-embed': "< 4.19.7",
+    'cubicweb-event': '< 1.8.9',
+    'cubicweb-expense': '>= 2.4.6, < 0.19.2',
+    'cubicweb-faq': '>= 1.9.5, != 1.18.5',
+    'cubicweb-fastimport': '>= 0.2.6, != 1.10.5',
+    'cubicweb-fckeditorcompat': ">= 1.9.0, < 4.0.8",
+    'cubicweb-fds': '>= 2.25.1',
+    'cubicweb-file': '== 1.18.7',  # see the changelog before upgrading
+    'cubicweb-fluid-design-system': '>= 0.24.1, != 1.20.7',
+    'cubicweb-folder': '== 4.25.4',
+    'cubicweb-forge': "< 4.7.7",
+    'cubicweb-forgotpwd': '== 2.11.3',
+    'cubicweb-forum': '>= 4.20.8, < 3.28.6',
+    'cubicweb-frbr': '>= 3.26.5, != 2.14.6',
+    'cubicweb-fresh': '>= 0.8.2, != 4.14.8',
+    'cubicweb-genomics': None,
+    'cubicweb-geocoding': '>= 0.14.5, != 4.25.4',
+    'cubicweb-graphql': '>= 2.15.3',
+    'cubicweb-i18ncontent': '< 4.24.1',  # see the changelog before upgrading
+    'cubicweb-i18nfield': '== 1.2.4',
+    'cubicweb-inlinedit': "== 0.5.6",
+    'cubicweb-intranet': '>= 4.17.8, != 2.0.8',
+    'cubicweb-inventory': '== 1.24.1',
+    'cubicweb-invoice': '== 0.30.5',
+    'cubicweb-iprogress': '>= 0.8.0',
+    'cubicweb-jqplot': ">= 4.28.2, < 1.20.6",
+    'cubicweb-jsonb': '== 0.17.5',
+    'cubicweb-jsonld': '>= 4.4.8',
+    'cubicweb-jsonschema': '< 1.6.4',
+    'cubicweb-keyword': '< 4.2.6',  # see the changelog before upgrading
+    'cubicweb-leaflet': "== 1.27.4",
+    'cubicweb-link': '>= 3.17.4, != 3.10.2',
+    'cubicweb-localperms': None,
+    'cubicweb-mailinglist': '>= 0.9.2, < 0.5.1',
+    'cubicweb-mandrill': '>= 0.7.3, != 4.0.7',
+    'cubicweb-massmailing': ">= 1.28.7, != 3.10.2",
+    'cubicweb-mediaplayer': '>= 4.6.1, != 3.19.5',
+    'cubicweb-medicalexp': '>= 3.19.0, < 1.8.9',
+    'cubicweb-mercurial-server': '>= 2.25.7, != 2.25.1',
+    'cubicweb-mock-schema': '== 2.28.1',
+    'cubicweb-narval': ">= 4.10.8",  # see the changelog before upgrading
+    'cubicweb-nazca': '< 2.29.1',
+    'cubicweb-nazcaui': '== 0.15.8',
+    'cubicweb-ner': '>= 4.22.3, != 0.6.1',
+    'cubicweb-neuroimaging': '>= 4.29.2, < 2.3.8',
+    'cubicweb-nosylist': ">= 0.2.3, != 4.8.9",
+    'cubicweb-notebooks': '>= 0.0.7',
+    'cubicweb-oaipmh': '== 1.11.3',
+    'cubicweb-oauth': '>= 2.27.6, < 4.12.0',
+    'cubicweb-oauth2': None,
+    'cubicweb-openidrelay': ">= 4.9.8, != 2.25.3",
+    'cubicweb-osmfrance': '< 2.5.3',  # see the changelog before upgrading
+    'cubicweb-pdfexport': '>= 3.28.6',
+    'cubicweb-person': '>= 2.24.6, < 3.10.9',
+    'cubicweb-piwik': '== 2.8.8',
+    'cubicweb-portlets': ">= 0.12.4",
+    'cubicweb-postgis': '>= 2.21.2, != 4.24.5',
+    'cubicweb-preview': '>= 1.19.1',
+    'cubicweb-processing': '== 2.21.3',
+    'cubicweb-prometheus': '< 0.20.5',
+    'cubicweb-prov': ">= 3.18.3",
+    'cubicweb-pwd-policy': '== 0.7.8',
+    'cubicweb-pyramid': '>= 0.25.5',  # see the changelog before upgrading
+    'cubicweb-questionnaire': '>= 4.18.2, < 0.21.2',
+    'cubicweb-queueing': '>= 1.21.3',
+    'cubicweb-registration': ">= 0.18.5, < 2.23.9",
+    'cubicweb-relationwidget': None,
+    'cubicweb-rememberme': '== 0.21.4',
+    'cubicweb-rodolf': '< 0.27.3',
+    'cubicweb-rq': '== 3.15.9',
+    'cubicweb-rqlcontroller': ">= 3.17.5, != 2.13.6",
+    'cubicweb-s3storage': '>= 0.5.2',
+    'cubicweb-saem-ref': '>= 1.9.3, < 2.18.3',
+    'cubicweb-saml': '>= 2.12.5, != 4.22.1',  # see the changelog before upgrading
+    'cubicweb-searchui': '== 1.11.2',
+    'cubicweb-securityprofile': ">= 1.0.0, != 0.6.4",
+    'cubicweb-seda': '>= 4.15.0, < 2.25.6',
+    'cubicweb-semnews': '== 1.12.9',
+    'cubicweb-sentry': '< 2.11.0',
+    'cubicweb-seo': '< 1.14.0',
+    'cubicweb-sherpa': "< 1.3.5",
+    'cubicweb-shoppingcart': '>= 4.17.0, < 0.15.2',
+    'cubicweb-signedrequest': '>= 0.5.9, != 1.19.5',
+    'cubicweb-simplefacet': None,
+    'cubicweb-sioc': '>= 1.19.0, != 1.5.9',  # see the changelog before upgrading
+    'cubicweb-skillmat': ">= 1.13.5, < 4.20.5",
+    'cubicweb-skos': '== 2.29.8',
+    'cubicweb-slickgrid': '>= 2.8.9, != 2.30.8',
+    'cubicweb-squareui': '>= 4.4.5',
+    'cubicweb-subprocess': '>= 1.15.7, != 0.2.9',
+    'cubicweb-sysinfo': "== 1.4.8",
+    'cubicweb-tag': '== 4.26.0',
+    'cubicweb-tagsinput': '>= 2.27.1, != 0.25.9',
+    'cubicweb-task': '== 4.5.4',
+    'cubicweb-testcard': '>= 0.9.7, != 2.6.7',
+    'cubicweb-timeline': ">= 4.22.0, < 1.9.6",  # see the changelog before upgrading
+    'cubicweb-timeseries': '>= 0.11.8',
+    'cubicweb-timesheet': '>= 2.2.3, != 3.21.1',
+    'cubicweb-tracker': '< 0.9.3',
+    'cubicweb-trackervcs': '== 1.6.1',
+    'cubicweb-transactionlog': None,
+    'cubicweb-treeview': '>= 4.16.8, < 3.2.1',
+    'cubicweb-trustedauth': '>= 2.21.2, != 1.16.8',
+    'cubicweb-tsfacets': '>= 0.2.2',
+    'cubicweb-uitest': '< 1.28.1',
+    'cubicweb-varnish': ">= 2.16.5, != 2.4.9",
+    'cubicweb-vcreview': '>= 0.18.9, != 0.19.0',  # see the changelog before upgrading
+    'cubicweb-vcrs': '== 0.24.4',
+    'cubicweb-vcsfile': '>= 3.24.4, != 4.11.2',
+    'cubicweb-vcwiki': '>= 2.17.7, != 1.19.7',
+    'cubicweb-vtimeline': "== 3.20.9",
+    'cubicweb-web': '>= 0.18.8, != 4.30.3',
+    'cubicweb-wireit': '>= 4.21.9, < 4.30.7',
+    'cubicweb-workcase': '>= 1.9.2, < 2.30.4',
+    'cubicweb-worker': '>= 1.17.7, < 4.9.4',
+    'cubicweb-workorder': ">= 1.10.1, < 1.25.5",
+    'cubicweb-wsme': '== 1.14.1',
+    'cubicweb-zone': None,  # see the changelog before upgrading
+}
+
+__recommends__ = {
+    'cubicweb-comment': None,
+    'cubicweb-tag': '>= 1.8.0',
+}
+
+classifiers = [
+    'Environment :: Web Environment',
+    'Framework :: CubicWeb',
+    'Programming Language :: Python',
+    'Programming Language :: JavaScript',
+]
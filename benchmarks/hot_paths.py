@@ -0,0 +1,256 @@
+"""
+Measure the functions of the toolkit on which most of the time is spent.
+
+Usage:
+
+    python benchmarks/hot_paths.py
+    python benchmarks/hot_paths.py --runs 20 -k pkginfo
+    python benchmarks/hot_paths.py --json before.json
+    python benchmarks/hot_paths.py --compare before.json
+
+Everything runs offline on the fixtures of benchmarks/fixtures:
+
+* pypi/*.json: pypi json documents of cubicweb, setuptools and django (only
+  the fields used by the toolkit are kept)
+* __pkginfo__.py: a cube depending on all the cubes published on pypi
+* cube_list.html: a cube list page like the one of cubicweb.org
+
+and a mercurial repository with --files files created in a temporary
+directory at each run (skipped if hg isn't installed).
+
+Each benchmark is run --runs times and the median and best wall times are
+displayed. --json saves them and --compare displays the ratio of the medians
+to the ones of a previously saved file, to compare two commits.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from contextlib import redirect_stdout
+
+ROOT = os.path.realpath(os.path.join(os.path.split(os.path.realpath(__file__))[0], ".."))
+FIXTURES = os.path.join(ROOT, "benchmarks", "fixtures")
+
+sys.path.insert(0, ROOT)
+
+import cubetoolkit  # noqa
+import all_cubes  # noqa
+
+
+def fixture(*path):
+    return os.path.join(FIXTURES, *path)
+
+
+def setup_pypi_cache(cache_path):
+    """ Put the pypi fixtures in the cache like get_pypi_releases would do. """
+    os.makedirs(os.path.join(cache_path, "pypi"))
+
+    for filename in os.listdir(fixture("pypi")):
+        with open(fixture("pypi", filename), "r") as f:
+            data = json.load(f)
+
+        with open(os.path.join(cache_path, "pypi", filename), "w") as f:
+            json.dump({"date": time.time(), "etag": None, "last_modified": None, "data": data}, f)
+
+
+def pypi_fixture_for(name):
+    """ Every dependency of the __pkginfo__.py fixture is given the releases of
+    one of the pypi fixtures. """
+    if name in ("cubicweb", "setuptools", "django"):
+        return name
+
+    return "cubicweb" if name.startswith("cubicweb-") else ("setuptools", "django")[len(name) % 2]
+
+
+def build_depends():
+    depends, _ = cubetoolkit.parse_pkginfo(fixture("__pkginfo__.py"))
+
+    documents = {}
+    for name in ("cubicweb", "setuptools", "django"):
+        with open(fixture("pypi", "%s.json" % name), "r") as f:
+            documents[name] = json.load(f)
+
+    merged = {}
+
+    for key, value in depends.items():
+        all_versions = []
+
+        for version, files in documents[pypi_fixture_for(key)]["releases"].items():
+            all_versions.append(dict(files[0]) if files else {})
+            all_versions[-1]["version"] = version
+
+        merged[key] = {"pkg_name": key, "current_version_scheme": value, "all_versions": all_versions}
+
+    return merged
+
+
+def create_hg_repository(path, number_of_files):
+    """ A repository with python files, python scripts and other files in
+    nested directories, some of them using old style cube imports. """
+    for i in range(number_of_files):
+        directory = os.path.join(path, "package%d" % (i % 20), "module%d" % (i % 7))
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        kind = i % 10
+
+        if kind < 6:
+            filename, content = "file%d.py" % i, "import os\n\n\ndef function%d():\n    return os.getcwd()\n" % i
+        elif kind == 6:
+            filename, content = "file%d.py" % i, "from cubes.file.views import View\nimport cubes.comment\n\n\nView%d = View\n" % i
+        elif kind == 7:
+            filename, content = "script%d" % i, "#!/usr/bin/env python\nprint('script %d')\n" % i
+        elif kind == 8:
+            filename, content = "data%d" % i, "not a script %d\n" % i
+        else:
+            filename, content = "file%d.txt" % i, "text %d\n" % i
+
+        with open(os.path.join(directory, filename), "w") as f:
+            f.write(content)
+
+    subprocess.check_call(["hg", "init", path])
+    subprocess.check_call(["hg", "add", "--quiet"], cwd=path)
+    subprocess.check_call(["hg", "commit", "--quiet", "-m", "init", "-u", "benchmarks"], cwd=path)
+
+
+def get_benchmarks(temporary_path, number_of_files):
+    """ Returns [(name, setup, function)], function is called with the result
+    of setup and only it is timed. """
+    benchmarks = []
+
+    conditions = ["== 3.24.0", ">= 3.24.0, < 3.27.0", ">= 1.0, != 1.2.3, <= 4.0", "< 2.0", "> 0.1, < 0.9.5"] * 200
+    benchmarks.append(("parse_conditions (1000 schemes)", lambda: conditions,
+                       lambda conditions: [cubetoolkit.parse_conditions(x) for x in conditions]))
+
+    benchmarks.append(("filter_pkg_that_can_be_upgraded", build_depends,
+                       cubetoolkit.filter_pkg_that_can_be_upgraded))
+
+    depends = {key: "== 1.0" for key in ("cubicweb", "setuptools", "django")}
+    benchmarks.append(("merge_depends_with_pypi_info (cached)", lambda: dict(depends),
+                       lambda depends: cubetoolkit.merge_depends_with_pypi_info(depends, max_age=float("inf"))))
+
+    pkginfo_path = fixture("__pkginfo__.py")
+    benchmarks.append(("parse_pkginfo", lambda: pkginfo_path, cubetoolkit.parse_pkginfo))
+
+    def setup_render():
+        depends, pkginfo = cubetoolkit.parse_pkginfo(pkginfo_path)
+        return depends, pkginfo
+
+    def render_all_versions(arguments):
+        depends, pkginfo = arguments
+
+        for key in depends:
+            depends[key] = "== 99.0"
+            cubetoolkit.render_pkginfo(pkginfo, depends)
+
+    benchmarks.append(("render_pkginfo (each dependency)", setup_render, render_all_versions))
+
+    with open(fixture("cube_list.html"), "r") as f:
+        cube_list = f.read()
+
+    benchmarks.append(("parse_cube_list", lambda: cube_list, all_cubes.parse_cube_list))
+
+    if shutil.which("hg") is None:
+        print("Warning: hg isn't installed, skip the benchmarks using a mercurial repository")
+        return benchmarks
+
+    repository = os.path.join(temporary_path, "repository")
+    create_hg_repository(repository, number_of_files)
+
+    def clear_caches():
+        cubetoolkit._python_files_cache.clear()
+        cubetoolkit._cubes_imports_index.clear()
+        return repository
+
+    files_name = "(%d files)" % number_of_files
+
+    benchmarks.append(("_get_python_files cold %s" % files_name, clear_caches, cubetoolkit._get_python_files))
+    benchmarks.append(("_get_python_files warm %s" % files_name, lambda: repository, cubetoolkit._get_python_files))
+    benchmarks.append(("get_cubes_imports_index cold %s" % files_name, clear_caches,
+                       cubetoolkit.get_cubes_imports_index))
+    benchmarks.append(("get_cubes_imports_index warm %s" % files_name, lambda: repository,
+                       cubetoolkit.get_cubes_imports_index))
+
+    return benchmarks
+
+
+def measure(setup, function, runs):
+    timings = []
+
+    for _ in range(runs):
+        argument = setup()
+
+        # the toolkit is verbose
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function(argument)
+            timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+
+    return timings[len(timings) // 2], timings[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="measure the hot paths of the toolkit on the fixtures")
+    parser.add_argument("--runs", type=int, default=10, help="number of runs of each benchmark")
+    parser.add_argument("--files", type=int, default=3000, help="number of files of the mercurial repository")
+    parser.add_argument("-k", dest="filter", default=None, help="only run the benchmarks containing this text")
+    parser.add_argument("--json", default=None, help="save the results in this file")
+    parser.add_argument("--compare", default=None, help="compare with the results saved in this file")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)["results"]
+
+    temporary_path = tempfile.mkdtemp(prefix="cubetoolkit-benchmarks-")
+    results = {}
+
+    # don't touch the real cache
+    cubetoolkit.CACHE_PATH = os.path.join(temporary_path, "cache")
+    setup_pypi_cache(cubetoolkit.CACHE_PATH)
+
+    try:
+        benchmarks = get_benchmarks(temporary_path, args.files)
+
+        print("%-50s %10s %10s%s" % ("benchmark", "median", "best", " %10s %8s" % ("before", "ratio") if baseline else ""))
+
+        for name, setup, function in benchmarks:
+            if args.filter and args.filter not in name:
+                continue
+
+            median, best = measure(setup, function, args.runs)
+            results[name] = {"median": median, "best": best}
+
+            line = "%-50s %8.2fms %8.2fms" % (name, median, best)
+
+            if name in baseline:
+                line += " %8.2fms %7.2fx" % (baseline[name]["median"], median / baseline[name]["median"])
+
+            print(line)
+    finally:
+        shutil.rmtree(temporary_path)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "runs": args.runs,
+                "files": args.files,
+                "results": results,
+            }, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Measure the startup time of the cubetoolkit and all-cubes CLIs.
+
+Usage:
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 50 --max-ms 300
+
+Each command is launched --runs times in a new python process and the median
+and best wall times are displayed. The script exits with 1 if a median is
+above --max-ms or if importing the modules loads one of the heavy
+dependencies that must only be imported by the commands using them.
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.realpath(os.path.join(os.path.split(os.path.realpath(__file__))[0], ".."))
+
+HEAVY_MODULES = ("redbaron", "baron", "requests", "bs4", "packaging", "sqlite3")
+
+COMMANDS = [
+    ("import cubetoolkit", [sys.executable, "-c", "import cubetoolkit"]),
+    ("import all_cubes", [sys.executable, "-c", "import all_cubes"]),
+    ("cubetoolkit --help", [sys.executable, "cubetoolkit.py", "--help"]),
+    ("cubetoolkit generate-pyramid-ini --help", [sys.executable, "cubetoolkit.py", "generate-pyramid-ini", "--help"]),
+    ("all-cubes --help", [sys.executable, "all_cubes.py", "--help"]),
+]
+
+
+def measure(command, runs):
+    timings = []
+
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call(command, cwd=ROOT, stdout=subprocess.DEVNULL)
+        timings.append((time.time() - start) * 1000)
+
+    timings.sort()
+
+    return timings[len(timings) // 2], timings[0]
+
+
+def check_heavy_modules():
+    code = ("import sys, cubetoolkit, all_cubes; "
+            "print(' '.join(sorted(set(x.split('.')[0] for x in sys.modules) & set(%r))))" % (HEAVY_MODULES,))
+
+    return subprocess.check_output([sys.executable, "-c", code], cwd=ROOT).decode().split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="measure the startup time of the CLIs")
+    parser.add_argument("--runs", type=int, default=20, help="number of runs of each command")
+    parser.add_argument("--max-ms", type=float, default=None, help="fail if a median is above this number of ms")
+    args = parser.parse_args()
+
+    failed = False
+
+    print("%-45s %10s %10s" % ("command", "median", "best"))
+
+    for name, command in COMMANDS:
+        median, best = measure(command, args.runs)
+        print("%-45s %8.1fms %8.1fms" % (name, median, best))
+
+        if args.max_ms is not None and median > args.max_ms:
+            print("ERROR: '%s' median is above %sms" % (name, args.max_ms))
+            failed = True
+
+    heavy_modules = check_heavy_modules()
+
+    if heavy_modules:
+        print("ERROR: heavy modules loaded at import time: %s" % ", ".join(heavy_modules))
+        failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,53 +1,550 @@
 # encoding: utf-8
 
+import io
 import os
+import ast
 import re
 import sys
+import time
+import json
+import queue
+import struct
+import atexit
+import hashlib
+import shutil
+import signal
 import string
+import html
+import urllib.parse
 import random
+import bisect
 import tarfile
+import zipfile
+import tempfile
+import functools
+import fcntl
 import fnmatch
 import operator
 import itertools
+import threading
 import subprocess
 
 from datetime import datetime
-from distutils.version import LooseVersion
-from contextlib import contextmanager
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import argh
-import requests
 
-from redbaron import RedBaron
+# requests, sqlite3 and packaging are slow to import and only needed
+# by some commands, they are imported in the functions using them
 
 INSTANCES_PATH = os.path.expanduser("~/etc/cubicweb.d/")
+PYPI_INDEX_URL = "https://pypi.org/pypi"
+PYPI_JOBS = 8
+# number of seconds during which cached pypi information are used without
+# asking pypi if they have changed
+PYPI_CACHE_MAX_AGE = 0
+CACHE_PATH = os.path.join(os.path.expanduser(os.environ.get("XDG_CACHE_HOME", "~/.cache")), "cubetoolkit")
+TEST_OUTCOMES_DATABASE_NAME = "test_outcomes.sqlite"
+# autoupgradedependencies/<session>/ contains the logs and the journal of a session
+SESSIONS_PATH = "autoupgradedependencies"
+JOURNAL_NAME = "journal.jsonl"
 
+# where the releases of the dependencies are looked for, see get_pypi_releases
+index_settings = {
+    "url": PYPI_INDEX_URL,
+}
 
+SKELETON_URL = "https://hg.logilab.org/master/cubicweb/raw-file/%s/cubicweb/skeleton/%s.tmpl"
+SKELETON_TEMPLATES = ("setup.py", "MANIFEST.in", "tox.ini", "cubicweb_CUBENAME/__pkginfo__.py")
+# number of seconds before refreshing cached templates of a branch or a tag
+# like 'tip', templates of a changeset hash are never refreshed
+SKELETON_CACHE_TTL = 24 * 60 * 60
+
+# can be modified using the options of to-newstyle-cube
+skeleton_settings = {
+    "revision": "tip",
+    "path": None,
+    "offline": False,
+}
+
+# {(revision, template name): template content}
+_skeleton_templates = {}
+
+
+_http_session = None
+_http_pool_size = 0
+
+
+def get_http_session(pool_size=PYPI_JOBS):
+    """ Returns a requests session shared by all the HTTP calls, it keeps the
+    connections alive and retries on connection errors and server errors.
+
+    pool_size is the number of threads using the session at the same time,
+    the connection pool is enlarged if it's smaller. """
+    global _http_session, _http_pool_size
+
+    if _http_session is None:
+        import requests
+
+        _http_session = requests.Session()
+
+    if pool_size > _http_pool_size:
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retries = Retry(total=4, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retries)
+
+        _http_session.mount("http://", adapter)
+        _http_session.mount("https://", adapter)
+        _http_pool_size = pool_size
+
+    return _http_session
+
+
+def read_json_cache(name):
+    """ Returns the content of a json file in the cache dir or None. """
+    path = os.path.join(CACHE_PATH, name)
+
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "r") as cache_file:
+            return json.load(cache_file)
+    except ValueError:
+        print("Warning: cache file %s is corrupted, ignore it" % path)
+        return None
+
+
+def write_json_cache(name, data):
+    """ Atomically write data as a json file in the cache dir. """
+    path = os.path.join(CACHE_PATH, name)
+    directory = os.path.split(path)[0]
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    temporary_path = "%s.%s.%s.tmp" % (path, os.getpid(), threading.current_thread().ident)
+    with open(temporary_path, "w") as cache_file:
+        json.dump(data, cache_file)
+
+    os.rename(temporary_path, path)
+
+
+# spans of the current process, see span()
+_trace_events = []
+_trace_lock = threading.Lock()
+
+
+@contextmanager
+def span(name, category, **args):
+    """ Record how long the code in this block takes, the spans are displayed
+    by print_trace_timings and can be exported with write_trace. """
+    timestamp = time.time()
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            # chrome trace format uses microseconds
+            "ts": int(timestamp * 1000000),
+            "dur": int((time.perf_counter() - start) * 1000000),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+
+        with _trace_lock:
+            _trace_events.append(event)
+
+
+def traced(category):
+    """ Decorator recording a span for each call of the function, named after
+    it with its positional arguments. """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            arguments = " ".join([" ".join(map(str, x)) if isinstance(x, list) else str(x) for x in args])
+
+            with span(function.__name__, category, arguments=arguments[:200]):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def take_trace_events():
+    """ Returns the spans recorded so far and forget them, to send them from
+    a worker process to the main one. """
+    with _trace_lock:
+        events = list(_trace_events)
+        del _trace_events[:]
+
+    return events
+
+
+def add_trace_events(events):
+    with _trace_lock:
+        _trace_events.extend(events)
+
+
+def print_trace_timings():
+    """ Print the number of calls and the time spent in each category of
+    spans, spans of a same category running at the same time are summed. """
+    with _trace_lock:
+        events = list(_trace_events)
+
+    if not events:
+        return
+
+    timings = {}
+
+    for event in events:
+        calls, duration = timings.get(event["cat"], (0, 0))
+        timings[event["cat"]] = (calls + 1, duration + event["dur"] / 1000000.0)
+
+    category_column_width = max([len("phase")] + [len(x) for x in timings])
+
+    print("")
+    print("Time spent:")
+    print("%s  calls  duration" % "phase".ljust(category_column_width))
+
+    for category, (calls, duration) in sorted(timings.items(), key=lambda x: -x[1][1]):
+        print("%s  %5s  %7.1fs" % (category.ljust(category_column_width), calls, duration))
+
+
+def write_trace(path):
+    """ Write the spans in the chrome trace format (chrome://tracing, perfetto). """
+    with _trace_lock:
+        events = list(_trace_events)
+
+    with open(path, "w") as trace_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+
+    print("Trace written in %s" % path)
+
+
+# {repository root: (command server process or None if unavailable, lock)}
+_hg_command_servers = {}
+_hg_command_servers_lock = threading.Lock()
+
+
+def _read_hg_channel(process):
+    header = process.stdout.read(5)
+
+    if len(header) < 5:
+        raise EOFError("mercurial command server has stopped")
+
+    channel, length = struct.unpack(">cI", header)
+
+    # input channels only give the maximum size of the expected input
+    if channel in (b"I", b"L"):
+        return channel, length
+
+    return channel, process.stdout.read(length)
+
+
+def _start_hg_command_server(root):
+    """ Start 'hg serve --cmdserver pipe' for this repository, returns None
+    if it isn't available. """
+    try:
+        process = subprocess.Popen(["hg", "serve", "--cmdserver", "pipe", "--config", "ui.interactive=False"],
+                                   cwd=root, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        channel, hello = _read_hg_channel(process)
+    except (OSError, EOFError):
+        return None
+
+    if channel != b"o" or b"runcommand" not in hello:
+        process.kill()
+        return None
+
+    return process
+
+
+def _get_hg_command_server(path):
+    root = _find_hg_root(path)
+
+    if root is None:
+        return None, None
+
+    with _hg_command_servers_lock:
+        if root not in _hg_command_servers:
+            _hg_command_servers[root] = (_start_hg_command_server(root), threading.Lock())
+
+        return _hg_command_servers[root]
+
+
+def _run_hg_command_server(process, args):
+    """ Returns the return code, output and error output of a mercurial
+    command run by a command server. """
+    data = b"\0".join([arg.encode() for arg in args])
+    process.stdin.write(b"runcommand\n" + struct.pack(">I", len(data)) + data)
+    process.stdin.flush()
+
+    output, error = [], []
+
+    while True:
+        channel, data = _read_hg_channel(process)
+
+        if channel == b"o":
+            output.append(data)
+        elif channel == b"e":
+            error.append(data)
+        elif channel == b"r":
+            return struct.unpack(">i", data)[0], b"".join(output), b"".join(error)
+        elif channel in (b"I", b"L"):
+            # we never have anything to give, send an empty input
+            process.stdin.write(struct.pack(">I", 0))
+            process.stdin.flush()
+        elif channel.isupper():
+            raise EOFError("unexpected required channel '%s' from mercurial command server" % channel)
+
+
+@atexit.register
+def _stop_hg_command_servers():
+    for process, _ in _hg_command_servers.values():
+        if process is not None and process.poll() is None:
+            process.stdin.close()
+            process.wait()
+
+    _hg_command_servers.clear()
+
+
+@traced("hg")
+def _hg(args, path=".", check=True):
+    """ Run a mercurial command in path and returns its output.
+
+    Commands are sent to a long-lived command server per repository to avoid
+    paying mercurial startup on each call, it falls back to a new hg process
+    if the command server isn't available.
+
+    Raises subprocess.CalledProcessError if it fails and check is True. """
+    process, lock = _get_hg_command_server(path)
+    return_code = None
+
+    if process is not None:
+        try:
+            with lock:
+                # the command server keeps its cwd between commands
+                return_code, output, error = _run_hg_command_server(process, ["--cwd", os.path.realpath(path)] + args)
+        except (IOError, OSError, EOFError) as e:
+            print("Warning: mercurial command server error (%s), use a new hg process instead" % e)
+            _hg_command_servers[_find_hg_root(path)] = (None, lock)
+
+    if return_code is None:
+        hg_process = subprocess.Popen(["hg"] + args, cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = hg_process.communicate()
+        return_code = hg_process.returncode
+
+    sys.stderr.write(error.decode("utf-8", "replace"))
+    output = output.decode("utf-8", "replace")
+
+    if check and return_code != 0:
+        raise subprocess.CalledProcessError(return_code, ["hg"] + args, output)
+
+    return output
+
+
+def _find_hg_root(path="."):
+    path = os.path.realpath(path)
+
+    while not os.path.isdir(os.path.join(path, ".hg")):
+        parent = os.path.dirname(path)
+
+        if parent == path:
+            return None
+
+        path = parent
+
+    return path
+
+
+def _is_python_script(path):
+    """ Check if a file without extension has a python shebang. """
+    try:
+        with open(path, "rb") as script:
+            first_line = script.readline(256)
+    except (IOError, OSError) as e:
+        print("Warning: couldn't read %s (to check if it's a python script) because of %s" % (path, e))
+        return False
+
+    return first_line.startswith(b"#!") and b"python" in first_line
+
+
+# {realpath: (dirstate signature, python files)}
+_python_files_cache = {}
+
+
+@traced("python files")
 def _get_python_files(path="."):
-    python_files = []
+    """ Returns the python files tracked by mercurial, relative to path.
+
+    The result is cached until the mercurial dirstate changes, meaning that
+    files have been added, removed or moved. """
+    hg_root = _find_hg_root(path)
+    dirstate_signature = None
+
+    if hg_root is not None:
+        dirstate_stat = os.stat(os.path.join(hg_root, ".hg", "dirstate"))
+        dirstate_signature = (dirstate_stat.st_mtime_ns, dirstate_stat.st_size)
+
+    cached = _python_files_cache.get(os.path.realpath(path))
 
-    all_hg_files = subprocess.check_output(
-        "hg status -A", shell=True, cwd=path).decode().split("\n")
-    tracked_files = [x.split(" ", 1)[1] for x in all_hg_files if x.startswith("C ")]
+    if cached and dirstate_signature is not None and cached[0] == dirstate_signature:
+        return list(cached[1])
 
-    tracked_files = filter(None, tracked_files)
+    python_files = []
+
+    # only tracked files, removed files excluded, relative to path
+    tracked_files = filter(None, _hg(["files", "-0"], path).split("\0"))
 
     for file in tracked_files:
-        file = os.path.join(path, file)
+        file = os.path.normpath(os.path.join(path, file))
         if file.endswith(".py"):
             python_files.append(file)
-        elif os.path.isdir(file):
+        elif "." not in os.path.basename(file) and os.path.isfile(file) and _is_python_script(file):
+            python_files.append(file)
+
+    _python_files_cache[os.path.realpath(path)] = (dirstate_signature, python_files)
+
+    return list(python_files)
+
+
+# "cubes.x" anywhere (from cubes.x import y, import cubes.x, cubes.x.y(), ...)
+CUBES_DOTTED_REGEX = re.compile(r"(?<![\w.])cubes\.(\w+)")
+# from cubes import x, y as z / from cubes import (x, y) / from cubes import x, \ (newline) y
+CUBES_FROM_IMPORT_REGEX = re.compile(r"^([ \t]*)from[ \t]+cubes[ \t]+import[ \t]+(\((?:[^)#]|#[^\n]*)*\)|(?:[^\n#;\\]|\\\n)*)",
+                                     re.MULTILINE)
+# import cubes
+CUBES_BARE_IMPORT_REGEX = re.compile(r"^([ \t]*)import[ \t]+cubes[ \t]*(?:#[^\n]*)?$", re.MULTILINE)
+
+# {realpath: {python file: (mtime, size, cubes imported)}}
+_cubes_imports_index = {}
+
+
+def _parse_from_cubes_import(names):
+    """ Returns [(name, alias)] for the names of a 'from cubes import ...' """
+    result = []
+
+    # comments first, they can contain commas
+    names = re.sub(r"#[^\n]*", "", names)
+
+    for name in names.strip().strip("()").replace("\\\n", " ").split(","):
+        name = name.split()
+
+        if not name:
             continue
-        elif "." not in file:
-            try:
-                is_python_script = "python script" in subprocess.check_output(["file", file]).lower()
-            except Exception as e:
-                print("Warning: could launch the 'file' command on %s (to check if it's a python script) because of %s" % e)
-            else:
-                if is_python_script:
-                    python_files.append(file)
 
-    return python_files
+        result.append((name[0], name[2] if len(name) == 3 and name[1] == "as" else name[0]))
+
+    return result
+
+
+def _find_imported_cubes(text):
+    cubes = set(CUBES_DOTTED_REGEX.findall(text))
+
+    for match in CUBES_FROM_IMPORT_REGEX.finditer(text):
+        cubes.update([name for name, _ in _parse_from_cubes_import(match.group(2))])
+
+    return cubes
+
+
+def get_cubes_imports_index(path="."):
+    """ Returns {python file: set of the cubes it imports} for the old style
+    'cubes.x' imports of the project.
+
+    The index is built once per project and only the files whose mtime or
+    size changed since are read again. """
+    index = _cubes_imports_index.setdefault(os.path.realpath(path), {})
+    python_files = _get_python_files(path)
+
+    for python_file in set(index) - set(python_files):
+        del index[python_file]
+
+    for python_file in python_files:
+        try:
+            stat = os.stat(python_file)
+        except OSError:
+            index.pop(python_file, None)
+            continue
+
+        if python_file in index and index[python_file][:2] == (stat.st_mtime_ns, stat.st_size):
+            continue
+
+        with open(python_file, "r") as f:
+            index[python_file] = (stat.st_mtime_ns, stat.st_size, _find_imported_cubes(f.read()))
+
+    return {python_file: value[2] for python_file, value in index.items()}
+
+
+def _rewrite_cube_imports(text, cube_name):
+    """ Replace the imports of cubes.<cube_name> by cubicweb_<cube_name> """
+    new_module = "cubicweb_%s" % cube_name
+
+    # cubes.<cube_name>.x only works thanks to a bare 'import cubes' if the
+    # module isn't imported itself, import the new one next to it
+    uses_module = re.search(r"(?<![\w.])(?<!from )cubes\.%s\b" % re.escape(cube_name), text)
+    imports_module = re.search(r"^[ \t]*import[ \t]+cubes\.%s\b" % re.escape(cube_name), text, re.MULTILINE)
+
+    if uses_module and not imports_module:
+        text = CUBES_BARE_IMPORT_REGEX.sub(lambda match: "%s\n%simport %s" % (match.group(0), match.group(1), new_module),
+                                           text)
+
+    text = re.sub(r"(?<![\w.])cubes\.%s\b" % re.escape(cube_name), new_module, text)
+
+    def rewrite_from_import(match):
+        indentation, names = match.group(1), _parse_from_cubes_import(match.group(2))
+
+        if cube_name not in [name for name, _ in names]:
+            return match.group(0)
+
+        lines = []
+        others = [name if name == alias else "%s as %s" % (name, alias) for name, alias in names if name != cube_name]
+
+        if others:
+            lines.append("%sfrom cubes import %s" % (indentation, ", ".join(others)))
+
+        for name, alias in names:
+            if name == cube_name:
+                lines.append("%simport %s as %s" % (indentation, new_module, alias))
+
+        # keep the spaces before a trailing comment
+        trailing_spaces = match.group(2)[len(match.group(2).rstrip(" \t")):]
+
+        return "\n".join(lines) + trailing_spaces
+
+    return CUBES_FROM_IMPORT_REGEX.sub(rewrite_from_import, text)
+
+
+@traced("imports")
+def rewrite_cube_imports(cube_name, path="."):
+    """ Rewrite the old style imports of a cube in the files that use it,
+    according to the imports index. """
+    index = _cubes_imports_index.setdefault(os.path.realpath(path), {})
+
+    for python_file, cubes in sorted(get_cubes_imports_index(path).items()):
+        if cube_name not in cubes:
+            continue
+
+        with open(python_file, "r") as f:
+            text = f.read()
+
+        new_text = _rewrite_cube_imports(text, cube_name)
+
+        if new_text != text:
+            print("* change import to new format for cube %s in %s" % (cube_name, python_file))
+            with open(python_file, "w") as f:
+                f.write(new_text)
+
+        stat = os.stat(python_file)
+        index[python_file] = (stat.st_mtime_ns, stat.st_size, _find_imported_cubes(new_text))
 
 
 @contextmanager
@@ -106,6 +603,73 @@ def create_cube_folder(path, cube_root, cube_folder):
             print_warning('Error: Creating directory %s.' % cube_folder)
 
 
+@traced("skeleton")
+def get_skeleton_template(name):
+    """ Returns the content of a template of the cubicweb skeleton.
+
+    Templates are read from the local skeleton checkout if there is one, else
+    they are downloaded once per revision and kept in memory and in the cache
+    dir. """
+    revision = skeleton_settings["revision"]
+    key = (revision, name)
+
+    if key in _skeleton_templates:
+        return _skeleton_templates[key]
+
+    if skeleton_settings["path"]:
+        template_path = os.path.join(skeleton_settings["path"], "%s.tmpl" % name)
+
+        if not os.path.exists(template_path):
+            print("Error: template %s isn't in the skeleton checkout %s" % (name, skeleton_settings["path"]))
+            sys.exit(1)
+
+        with open(template_path, "r") as template_file:
+            _skeleton_templates[key] = template_file.read()
+
+        return _skeleton_templates[key]
+
+    cache_path = os.path.join(CACHE_PATH, "skeleton", revision, "%s.tmpl" % name)
+    is_changeset_hash = re.match("^[0-9a-f]{40}$", revision) is not None
+
+    if os.path.exists(cache_path) and (skeleton_settings["offline"] or is_changeset_hash or
+                                       time.time() - os.path.getmtime(cache_path) < SKELETON_CACHE_TTL):
+        with open(cache_path, "r") as cache_file:
+            _skeleton_templates[key] = cache_file.read()
+
+        return _skeleton_templates[key]
+
+    if skeleton_settings["offline"]:
+        print("Error: offline mode but template %s for revision %s isn't in the cache" % (name, revision))
+        sys.exit(1)
+
+    import requests
+
+    try:
+        response = get_http_session().get(SKELETON_URL % (revision, name), timeout=30)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        if not os.path.exists(cache_path):
+            print("Error: couldn't download template %s: %s" % (name, e))
+            sys.exit(1)
+
+        print("Warning: couldn't download template %s (%s), use the cached one" % (name, e))
+
+        with open(cache_path, "r") as cache_file:
+            _skeleton_templates[key] = cache_file.read()
+
+        return _skeleton_templates[key]
+
+    _skeleton_templates[key] = response.content.decode()
+
+    if not os.path.exists(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    with open(cache_path, "w") as cache_file:
+        cache_file.write(_skeleton_templates[key])
+
+    return _skeleton_templates[key]
+
+
 def update_pkginfo(pkginfo):
     """ Update __pkginfo__.py content. """
 
@@ -128,14 +692,10 @@ def update_pkginfo(pkginfo):
     if '__recommends__' in __pkginfo__:
         context['__recommends__'] = __pkginfo__['__recommends__']
 
-    command = "hg rm %s" % pkginfo
-    subprocess.Popen(command, shell=True).wait()
+    # the file stays tracked, it's only rewritten
+    template = get_skeleton_template("cubicweb_CUBENAME/__pkginfo__.py")
 
-    url = "https://hg.logilab.org/master/cubicweb/raw-file/tip/cubicweb/skeleton/cubicweb_CUBENAME/__pkginfo__.py.tmpl"
-
-    response = requests.get(url)
     with open(pkginfo, 'w') as out:
-        template = response.content.decode()
         new_pkginfo = template % context
         new_pkginfo = new_pkginfo.split('\n')
 
@@ -146,276 +706,1125 @@ def update_pkginfo(pkginfo):
             #     l = re.sub(r"'^.*cubicweb' ?: ?'>?= ?'\d{1}\.\d{1}\.\d{1}',?.*", "'cubicweb': '>= 3.24.0'", l)
             out.write(line + '\n')
 
-    command = "hg add %s" % pkginfo
-    subprocess.Popen(command, shell=True).wait()
     print_warning('Info: Successfully updated __pkginfo__.py.')
 
 
-def move_cube_files(path, cube_root, cube_folder):
+def new_hg_operations():
+    """ Returns a container for the file operations to do with mercurial. """
+    return {
+        "rm": [],
+        "add": [],
+        "mv": [],
+    }
+
+
+def apply_hg_operations(path, hg_operations):
+    """ Do the collected file operations with one mercurial call per kind of
+    operation instead of one per file. """
+
+    if hg_operations["rm"]:
+        _hg(["rm", "--"] + hg_operations["rm"], path, check=False)
+
+    if hg_operations["add"]:
+        _hg(["add", "--quiet", "--"] + hg_operations["add"], path, check=False)
+
+    for sources, destination in hg_operations["mv"]:
+        _hg(["mv", "--"] + sources + [destination], path, check=False)
+
+    hg_operations.update(new_hg_operations())
+
+
+def move_cube_files(path, cube_root, cube_folder, hg_operations=None):
     """ Move cube files from root to cube folder. """
 
-    ftnm = _ftnm(cube_root)
-    dtnm = _dtnm(cube_root)
-    cf = []
+    apply_now = hg_operations is None
+    if apply_now:
+        hg_operations = new_hg_operations()
+
+    # a single failing source aborts the whole 'hg mv' call, so those lists
+    # have to be computed from the cube path and not from the current dir
+    ftnm = _ftnm(path)
+    dtnm = _dtnm(path)
+    cf = []
+
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            if fnmatch.fnmatch(filename, '__pkginfo__.py'):
+                update_pkginfo(os.path.join(path, filename))
+            if filename not in ftnm:
+                cf.append(filename)
+
+        for dirname in dirs:
+            if dirname not in dtnm:
+                cf.append(dirname)
+        break  # we just need level 1 walk
+
+    if cf:
+        hg_operations["mv"].append((cf, cube_folder))
+
+    if apply_now:
+        apply_hg_operations(path, hg_operations)
+
+    print_warning('Info: cube files successfully moved into %s' % cube_root)
+
+
+def replace_cube_file(path, cube_root, filename, hg_operations=None):
+    """ Replace files that needs to be rewritten using the skeleton. """
+
+    apply_now = hg_operations is None
+    if apply_now:
+        hg_operations = new_hg_operations()
+
+    with cd(path):
+        context = {'cubename': cube_root, 'distname': 'cubicweb-' + cube_root}
+        template = get_skeleton_template(filename)
+
+        with open(filename, 'w') as out:
+            out.write(template % context)
+
+        # in case it wasn't tracked
+        hg_operations["add"].append(filename)
+        print_warning('Info: %s successfully updated' % filename)
+
+    if apply_now:
+        apply_hg_operations(path, hg_operations)
+
+
+def remove_useless_files(cube_root, hg_operations=None):
+    """ Remove all the files that are no more used. """
+
+    apply_now = hg_operations is None
+    if apply_now:
+        hg_operations = new_hg_operations()
+
+    for filename in ['apycot.ini', 'pytestconf.py']:
+        hg_operations["rm"].append(filename)
+        print_warning('Info: %s successfully removed' % filename)
+
+    if apply_now:
+        apply_hg_operations(cube_root, hg_operations)
+
+
+def fix_unittest_import(path, filename):
+    """ Make sure we use unittest from standard lib."""
+    with cd(path):
+        content = []
+        with open(filename, 'r') as f:
+            content = f.readlines()
+
+        with open(filename, 'w') as f:
+            for line in content:
+                if "unittest_main" in line:
+                    line = re.sub(r"^from logilab\.common\.testlib import unittest_main$", r"import unittest", line)
+                    line = re.sub(r"^    from logilab\.common\.testlib import unittest_main$", r"    import unittest", line)
+                    line = re.sub(r"^    unittest_main\(\)$", "    unittest.main()", line)
+                f.write(line)
+
+
+def fix_cube_import(cube_root, filename):
+    """ Make sure we import cube using new layout."""
+    with cd(cube_root):
+        content = []
+        with open(filename, 'r') as f:
+            content = f.readlines()
+
+        with open(filename, 'w') as f:
+            for line in content:
+                if "cubes." in line:
+                    line = re.sub(r"", r"", line)
+                    f.write(line)
+
+
+@argh.arg("--skeleton-path", help="use the templates of this local checkout of cubicweb/skeleton instead of downloading them")
+@argh.arg("--skeleton-revision", help="revision of cubicweb from which the skeleton templates are downloaded")
+@argh.arg("--skeleton-offline", help="only use the skeleton templates already in the cache")
+def to_newstyle_cube(path, skeleton_path=None, skeleton_revision="tip", skeleton_offline=False):
+    "Upgrade oldstyle CW cube to newstyle"
+    path = os.path.realpath(os.path.expanduser(path))
+
+    if not os.path.exists(path):
+        print("Error: '%s' doesn't exist" % path)
+        sys.exit(1)
+
+    skeleton_settings["path"] = os.path.realpath(os.path.expanduser(skeleton_path)) if skeleton_path else None
+    skeleton_settings["revision"] = skeleton_revision
+    skeleton_settings["offline"] = skeleton_offline
+
+    # get all the templates before modifying anything
+    for name in SKELETON_TEMPLATES:
+        get_skeleton_template(name)
+
+    cube_root = os.path.basename(path)
+    cube_folder = 'cubicweb_%s' % cube_root
+
+    # collect all the mercurial operations to do them in a few calls
+    hg_operations = new_hg_operations()
+
+    # setup.py and MANIFEST.in can just be replaced
+    for i in ['setup.py', 'MANIFEST.in', 'tox.ini']:
+        replace_cube_file(path, cube_root, i, hg_operations)
+
+    create_cube_folder(path, cube_root, cube_folder)
+    move_cube_files(path, cube_root, cube_folder, hg_operations)
+
+    apply_hg_operations(path, hg_operations)
+
+    py_files = _get_python_files(path)
+    # remove_useless_files
+
+    for f in py_files:
+        fix_unittest_import(path, f)
+        # fix_cubes_import
+        # automatically call autopep8?
+
+
+def find_pkginfo(path):
+    dirs = os.listdir(path)
+
+    if "__pkginfo__.py" in dirs:
+        return os.path.join(path, "__pkginfo__.py")
+
+    cube_subdirs = [os.path.join(path, x) for x in dirs if os.path.isdir(x) and x.startswith("cubicweb_")]
+
+    if not cube_subdirs:
+        print("Couldn't find the __pkginfo__.py file :(")
+        sys.exit(1)
+
+    for subdir in cube_subdirs:
+        if "__pkginfo__.py" in os.listdir(subdir):
+            return os.path.join(subdir, "__pkginfo__.py")
+
+    print("Couldn't find the __pkginfo__.py file :(")
+    sys.exit(1)
+
+
+@traced("pkginfo")
+def parse_pkginfo(path):
+    """ Returns the __depends__ dict of a __pkginfo__.py and what is needed to
+    rewrite its values with render_pkginfo: its source and the position of
+    each value in it. """
+    with open(path, "rb") as f:
+        source = f.read()
+
+    try:
+        tree = ast.parse(source, path)
+    except SyntaxError as e:
+        print("I couldn't parse %s: %s :(" % (path, e))
+        sys.exit(1)
+
+    assignments = [x for x in tree.body if isinstance(x, ast.Assign) and
+                   any([isinstance(target, ast.Name) and target.id == "__depends__" for target in x.targets])]
+
+    if not assignments:
+        print("I couldn't find __depends__ in the __pkginfo__.py :(")
+        sys.exit(1)
+
+    depends_node = assignments[0].value
+
+    if not isinstance(depends_node, ast.Dict):
+        print("__depends__ in the __pkginfo__.py isn't a dict, I don't know how to modify it :(")
+        sys.exit(1)
+
+    # ast positions are (line, utf-8 byte offset in the line)
+    lines_offsets = [0]
+    for line in source.splitlines(True):
+        lines_offsets.append(lines_offsets[-1] + len(line))
+
+    depends = {}
+    positions = {}
+
+    for key, value in zip(depends_node.keys, depends_node.values):
+        try:
+            key, depends[key] = ast.literal_eval(key), ast.literal_eval(value)
+        except ValueError:
+            print("__depends__ in the __pkginfo__.py contains non literal values, I don't know how to modify it :(")
+            sys.exit(1)
+
+        positions[key] = (lines_offsets[value.lineno - 1] + value.col_offset,
+                          lines_offsets[value.end_lineno - 1] + value.end_col_offset)
+
+    pkginfo = {
+        "source": source,
+        "depends": dict(depends),
+        "positions": positions,
+    }
+
+    return depends, pkginfo
+
+
+@traced("pkginfo")
+def render_pkginfo(pkginfo, depends):
+    """ Returns the content of the __pkginfo__.py with the values of
+    __depends__ that differ from the original ones replaced, everything else
+    is kept as is. """
+    source = pkginfo["source"]
+    parts = []
+    previous_end = 0
+
+    for key, (start, end) in sorted(pkginfo["positions"].items(), key=lambda x: x[1]):
+        if depends[key] is None or depends[key] == pkginfo["depends"][key]:
+            continue
+
+        # keep the string prefix (u'') and the quotes used in the file
+        value = source[start:end]
+        prefix = value[:len(value) - len(value.lstrip(b"uUrRbB"))]
+        quote = b'"' if value[len(prefix):].startswith(b'"') else b"'"
+
+        parts.extend([source[previous_end:start], prefix + quote + depends[key].encode("Utf-8") + quote])
+        previous_end = end
+
+    parts.append(source[previous_end:])
+
+    return b"".join(parts).decode("Utf-8")
+
+
+def _get_cached_http_document(url, cache_name, pkg_name, max_age, is_json):
+    """ Returns the document at this url (decoded if is_json), or None if
+    unavailable.
+
+    Responses are cached on disk with their ETag and Last-Modified headers so
+    the server only needs to answer '304 Not Modified' when nothing has
+    changed. """
+    cache = read_json_cache(cache_name)
+
+    if cache and time.time() - cache["date"] < max_age:
+        print("Get all releases of %s (from cache)" % pkg_name)
+        return cache["data"]
+
+    print("Get all releases of %s..." % pkg_name)
+
+    import requests
+
+    headers = {}
+    if cache and cache.get("etag"):
+        headers["If-None-Match"] = cache["etag"]
+    if cache and cache.get("last_modified"):
+        headers["If-Modified-Since"] = cache["last_modified"]
+
+    try:
+        response = get_http_session().get(url, headers=headers, timeout=30)
+
+        if response.status_code == 404:
+            print("Warning: %s doesn't exist on %s, skip it" % (pkg_name, index_settings["url"]))
+            return None
+
+        response.raise_for_status()
+    except requests.RequestException as e:
+        if cache:
+            print("Warning: couldn't get %s information from %s (%s), use the cached ones" % (pkg_name, index_settings["url"], e))
+            return cache["data"]
+
+        print("Warning: couldn't get %s information from %s (%s), skip it" % (pkg_name, index_settings["url"], e))
+        return None
+
+    if response.status_code == 304:
+        data = cache["data"]
+    else:
+        data = response.json() if is_json else response.text
+
+    write_json_cache(cache_name, {
+        "date": time.time(),
+        "etag": response.headers.get("ETag", cache.get("etag") if cache else None),
+        "last_modified": response.headers.get("Last-Modified", cache.get("last_modified") if cache else None),
+        "data": data,
+    })
+
+    return data
+
+
+def _normalize_pkg_name(pkg_name):
+    # PEP 503
+    return re.sub(r"[-_.]+", "-", pkg_name).lower()
+
+
+def _parse_distribution_filename(filename, pkg_name):
+    """ Returns (version, packagetype) of a sdist or wheel of pkg_name, or
+    None if it isn't one. """
+    if filename.endswith(".whl"):
+        parts = filename[:-len(".whl")].split("-")
+
+        if len(parts) < 5 or _normalize_pkg_name(parts[0]) != _normalize_pkg_name(pkg_name):
+            return None
+
+        return parts[1], "bdist_wheel"
+
+    for extension in (".tar.gz", ".tar.bz2", ".tar.xz", ".tgz", ".zip"):
+        if filename.endswith(extension):
+            name_and_version = filename[:-len(extension)]
+            break
+    else:
+        return None
+
+    name, separator, version = name_and_version[:len(pkg_name)], name_and_version[len(pkg_name):len(pkg_name) + 1], name_and_version[len(pkg_name) + 1:]
+
+    if separator != "-" or not version or _normalize_pkg_name(name) != _normalize_pkg_name(pkg_name):
+        return None
+
+    return version, "sdist"
+
+
+def _releases_from_distributions(distributions, pkg_name):
+    """ Build the 'releases' of a pypi json document from [(filename, url)],
+    sdists first since the first distribution of each release is used. """
+    releases = {}
+
+    for filename, url in distributions:
+        parsed = _parse_distribution_filename(filename, pkg_name)
+
+        if parsed is None:
+            continue
+
+        version, packagetype = parsed
+        releases.setdefault(version, []).append({
+            "filename": filename,
+            "packagetype": packagetype,
+            "url": url,
+        })
+
+    for files in releases.values():
+        files.sort(key=lambda x: x["packagetype"] != "sdist")
+
+    return {"releases": releases}
+
+
+def _parse_simple_index(content, page_url, pkg_name):
+    """ Returns the pypi json like document of a PEP 503 project page. """
+    distributions = []
+
+    for attributes, filename in re.findall(r"<a\s([^>]*)>([^<]*)</a>", content, re.IGNORECASE):
+        href = re.search(r"""href\s*=\s*["']([^"']*)["']""", attributes)
+
+        # yanked releases can't be installed without an exact pin
+        if href is None or "data-yanked" in attributes:
+            continue
+
+        url = urllib.parse.urljoin(page_url, html.unescape(href.group(1))).split("#", 1)[0]
+        distributions.append((html.unescape(filename).strip(), url))
+
+    return _releases_from_distributions(distributions, pkg_name)
+
+
+def _file_url_to_path(url):
+    import urllib.request
+
+    return urllib.request.url2pathname(urllib.parse.urlparse(url).path)
+
+
+def _path_to_file_url(path):
+    import urllib.request
+
+    return urllib.parse.urljoin("file:", urllib.request.pathname2url(os.path.abspath(path)))
+
+
+def _get_local_releases(pkg_name, path):
+    """ Returns the pypi json like document of pkg_name from a local mirror,
+    which can contain for each package either:
+
+    * its pypi json document in <name>.json or <name>/json
+    * its PEP 503 simple index page in <normalized name>/index.html
+    * its sdists and wheels, directly in the directory or in <normalized name>/
+    """
+    normalized_name = _normalize_pkg_name(pkg_name)
+
+    for name in (pkg_name, pkg_name.lower(), normalized_name):
+        for json_path in (os.path.join(path, "%s.json" % name), os.path.join(path, name, "json")):
+            if os.path.isfile(json_path):
+                print("Get all releases of %s (from %s)" % (pkg_name, json_path))
+
+                with open(json_path, "r") as json_file:
+                    return json.load(json_file)
+
+    project_path = os.path.join(path, normalized_name)
+    index_path = os.path.join(project_path, "index.html")
+
+    if os.path.isfile(index_path):
+        print("Get all releases of %s (from %s)" % (pkg_name, index_path))
+
+        with open(index_path, "r") as index_file:
+            return _parse_simple_index(index_file.read(), _path_to_file_url(index_path), pkg_name)
+
+    distributions = []
+
+    for directory in (path, project_path):
+        if os.path.isdir(directory):
+            distributions.extend([(x, _path_to_file_url(os.path.join(directory, x))) for x in sorted(os.listdir(directory))])
+
+    data = _releases_from_distributions(distributions, pkg_name)
+
+    if not data["releases"]:
+        print("Warning: %s doesn't exist in %s, skip it" % (pkg_name, path))
+        return None
+
+    print("Get all releases of %s (from %s)" % (pkg_name, path))
+
+    return data
+
+
+@traced("pypi")
+def get_pypi_releases(pkg_name, max_age=PYPI_CACHE_MAX_AGE):
+    """ Returns pypi json information for pkg_name, or None if unavailable.
+
+    They come from the index of index_settings["url"] which can be:
+
+    * a pypi like json API (https://pypi.org/pypi, warehouse instances, ...)
+    * a PEP 503 simple index, if the url ends with /simple (or /+simple for
+      a devpi index)
+    * a local directory mirror (a path or a file:// url), see _get_local_releases
+
+    Only the first distribution of each release is used (it's the one where
+    cubes formats are checked). """
+    index_url = index_settings["url"].rstrip("/")
+
+    if index_url.startswith("file:"):
+        return _get_local_releases(pkg_name, _file_url_to_path(index_url))
+
+    if "://" not in index_url:
+        return _get_local_releases(pkg_name, os.path.expanduser(index_url))
+
+    if index_url == PYPI_INDEX_URL:
+        cache_name = os.path.join("pypi", "%s.json" % pkg_name.lower())
+    else:
+        cache_name = os.path.join("pypi", hashlib.sha1(index_url.encode()).hexdigest(), "%s.json" % pkg_name.lower())
+
+    if index_url.endswith(("/simple", "/+simple")):
+        page_url = "%s/%s/" % (index_url, _normalize_pkg_name(pkg_name))
+        content = _get_cached_http_document(page_url, cache_name, pkg_name, max_age, is_json=False)
+
+        return _parse_simple_index(content, page_url, pkg_name) if content is not None else None
+
+    return _get_cached_http_document("%s/%s/json" % (index_url, pkg_name), cache_name, pkg_name, max_age, is_json=True)
+
+
+def merge_depends_with_pypi_info(depends, jobs=PYPI_JOBS, max_age=PYPI_CACHE_MAX_AGE):
+    new_depends = {}
+
+    pkg_names = [key.split("[", 1)[0] for key in depends]
+
+    # requests are done concurrently over the pooled connections of the session,
+    # with a connection per thread
+    get_http_session(pool_size=jobs)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        all_data = list(executor.map(functools.partial(get_pypi_releases, max_age=max_age), pkg_names))
+
+    for (key, value), pkg_name, data in zip(depends.items(), pkg_names, all_data):
+        if data is None:
+            continue
+
+        all_versions = []
+
+        for key2, value2 in data["releases"].items():
+            # sometime we don't have metadata information for a release :|
+            all_versions.append(value2[0] if value2 else {})
+            all_versions[-1]["version"] = key2
+
+        new_depends[key] = {
+            "pkg_name": pkg_name,
+            "current_version_scheme": value,
+            "all_versions": all_versions
+        }
+
+    return new_depends
+
+
+def build_version_index(all_versions):
+    """ Returns (keys, versions): the versions metadata sorted by their PEP 440
+    version and the matching parsed versions, each version being parsed only
+    once. Invalid version numbers are dropped. """
+    parsed_versions = []
+
+    for version in all_versions:
+        key = _version_key(version["version"])
+
+        if key is not None:
+            parsed_versions.append((key, version))
+
+    parsed_versions.sort(key=lambda x: x[0])
+
+    return [x[0] for x in parsed_versions], [x[1] for x in parsed_versions]
+
+
+def find_maximum_compatible_version(keys, conditions):
+    """ Returns the index in keys (sorted) of the highest version matching all
+    the conditions, or None. Every condition is resolved by binary search. """
+    lowest, highest = 0, len(keys)
+    excluded = set()
+
+    for (op, version) in conditions:
+        version = _version_key(version)
+
+        if version is None:
+            continue
+
+        if op is operator.eq:
+            lowest, highest = max(lowest, bisect.bisect_left(keys, version)), min(highest, bisect.bisect_right(keys, version))
+        elif op is operator.ge:
+            lowest = max(lowest, bisect.bisect_left(keys, version))
+        elif op is operator.gt:
+            lowest = max(lowest, bisect.bisect_right(keys, version))
+        elif op is operator.le:
+            highest = min(highest, bisect.bisect_right(keys, version))
+        elif op is operator.lt:
+            highest = min(highest, bisect.bisect_left(keys, version))
+        elif op is operator.ne:
+            excluded.add(version)
+
+    compatible = [index for index in range(highest - 1, lowest - 1, -1) if keys[index] not in excluded]
+
+    # like pip, only consider pre-releases if nothing else matches
+    for index in compatible:
+        if not keys[index].is_prerelease:
+            return index
+
+    return compatible[0] if compatible else None
+
+
+def filter_pkg_that_can_be_upgraded(depends):
+    no_upgrades = []
+    new_depends = {}
+
+    for key, value in depends.items():
+        conditions = parse_conditions(value["current_version_scheme"])
+
+        if conditions is None:
+            print("No specified version for %s, drop it" % key)
+            continue
+
+        keys, all_versions = build_version_index(value["all_versions"])
+        value["all_versions"] = all_versions
+
+        maximum_version = find_maximum_compatible_version(keys, conditions)
+
+        if maximum_version is None:
+            print("No released version of %s matches '%s', drop it" % (key, value["current_version_scheme"]))
+            continue
+
+        # everything after the maximum compatible version, except pre-releases
+        first_upgrade = bisect.bisect_right(keys, keys[maximum_version])
+        possible_upgrades = [all_versions[i] for i in range(first_upgrade, len(keys)) if not keys[i].is_prerelease]
+
+        if possible_upgrades:
+            new_depends[key] = value
+            new_depends[key]["possible_upgrades"] = possible_upgrades
+        else:
+            no_upgrades.append(key)
+
+    if no_upgrades:
+        print("Skipped packages that don't need to be upgraded: %s" % (", ".join(no_upgrades)))
+
+    if new_depends:
+        print("")
+        print("Packages that can upgrades with all those available verisons:")
+        for key, value in new_depends.items():
+            print("* %s (%s) to %s" % (key, value["current_version_scheme"], ", ".join([x["version"] for x in value["possible_upgrades"]])))
+
+    return new_depends
+
+
+def parse_conditions(conditions):
+    string_to_operator = {
+        "==": operator.eq,
+        "<": operator.lt,
+        "<=": operator.le,
+        "!=": operator.ne,
+        ">=": operator.ge,
+        ">": operator.gt,
+    }
+
+    parsed_conditions = []
+
+    if not conditions:
+        return None
+
+    for i in conditions.split(","):
+        version_operator, version_number = re.match("(==|!=|>=|<=|>|<) *([^ ,]*)", i.strip()).groups()
+
+        parsed_conditions.append([
+            string_to_operator[version_operator],
+            version_number,
+        ])
+
+    return parsed_conditions
+
+
+def _version_key(version):
+    """ Returns the PEP 440 version, or None if it's not a valid version """
+    from packaging.version import Version, InvalidVersion
+
+    try:
+        return Version(version)
+    except InvalidVersion:
+        return None
+
+
+CUBE_FORMATS_CACHE_NAME = "cube_formats.json"
+
+# {cube name: {version: True if it's a new style cube}}, loaded from the cache
+_cube_formats = {}
+_cube_formats_lock = threading.Lock()
+
+
+@contextmanager
+def _open_distribution(url):
+    """ Yields a binary file object streaming the distribution at this url,
+    which can be a file:// url of a local mirror. """
+    if url.startswith("file:"):
+        with open(_file_url_to_path(url), "rb") as distribution:
+            yield distribution
+
+        return
+
+    with closing(get_http_session().get(url, stream=True, timeout=30)) as response:
+        response.raise_for_status()
+        yield response.raw
+
+
+@traced("archive")
+def _detect_cube_format(cube_name, url):
+    """ Look inside a release archive to know if it's a new style cube.
+
+    sdists are streamed and only read until the cube package or the root
+    __pkginfo__.py of an old style cube is found. """
+    with _open_distribution(url) as distribution:
+        if url.endswith((".whl", ".zip")):
+            archive = zipfile.ZipFile(io.BytesIO(distribution.read()))
+            names = [x.split("/", 1)[1] if url.endswith(".zip") else x for x in archive.namelist() if "/" in x]
+
+            return any([x.startswith("cubicweb_%s/" % cube_name) for x in names])
+
+        for member in tarfile.open(fileobj=distribution, mode="r|*"):
+            parts = member.name.split("/")
+
+            if len(parts) < 2:
+                continue
+
+            if parts[1] == "cubicweb_%s" % cube_name:
+                return True
+
+            if parts[1] == "__pkginfo__.py":
+                return False
+
+    return False
+
+
+def update_cube_formats_cache(cube_formats):
+    """ Merge {cube: {version: is new style}} in the cube formats cache file.
+
+    Other processes (all-cubes --jobs) write it too: it's read again under an
+    exclusive lock right before being written to not lose their entries. """
+    lock_path = os.path.join(CACHE_PATH, CUBE_FORMATS_CACHE_NAME + ".lock")
+
+    if not os.path.exists(CACHE_PATH):
+        os.makedirs(CACHE_PATH, exist_ok=True)
+
+    with open(lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        on_disk = read_json_cache(CUBE_FORMATS_CACHE_NAME) or {}
+
+        for cube_name, versions in cube_formats.items():
+            on_disk.setdefault(cube_name, {}).update(versions)
+
+        write_json_cache(CUBE_FORMATS_CACHE_NAME, on_disk)
+
+    # what the other processes have found is worth knowing too
+    for cube_name, versions in on_disk.items():
+        _cube_formats.setdefault(cube_name, {}).update(versions)
+
+
+def is_new_style_cube_release(cube_name, version_metadata):
+    """ Returns True if this release of the cube uses the new cubicweb_<name>
+    package layout.
+
+    Results are memoized on disk per (cube, version) and, since cubes never go
+    back to the old layout, deduced from the already known releases when
+    possible. """
+    version = version_metadata["version"]
+
+    with _cube_formats_lock:
+        if not _cube_formats:
+            _cube_formats.update(read_json_cache(CUBE_FORMATS_CACHE_NAME) or {})
+
+        known_formats = dict(_cube_formats.get(cube_name, {}))
+
+    if version in known_formats:
+        return known_formats[version]
+
+    version_key = _version_key(version)
+
+    for known_version, is_new_style in known_formats.items():
+        known_version_key = _version_key(known_version)
+
+        if version_key is None or known_version_key is None:
+            continue
+
+        if is_new_style and known_version_key <= version_key:
+            return True
+
+        if not is_new_style and known_version_key >= version_key:
+            return False
+
+    if "url" not in version_metadata:
+        print("Warning: there is no distributions files for %s version %s, I can't check if the cube format has changed" % (cube_name, version))
+        return False
+
+    is_new_style = _detect_cube_format(cube_name, version_metadata["url"])
+
+    with _cube_formats_lock:
+        _cube_formats.setdefault(cube_name, {})[version] = is_new_style
+        update_cube_formats_cache({cube_name: {version: is_new_style}})
+
+    return is_new_style
+
+
+# seconds left to the tests to stop after SIGTERM before being sent SIGKILL
+KILL_GRACE_PERIOD = 3
+
+
+def _kill_process_group(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except OSError:
+        # already dead
+        pass
+
+
+def _kill_process_tree(process):
+    """ Kill a process started with start_new_session=True and all its children.
+
+    The processes ignoring SIGTERM are sent SIGKILL after KILL_GRACE_PERIOD,
+    without blocking the caller. """
+    _kill_process_group(process.pid, signal.SIGTERM)
+
+    # the group outlives its leader as long as one of its processes is alive
+    timer = threading.Timer(KILL_GRACE_PERIOD, _kill_process_group, [process.pid, signal.SIGKILL])
+    timer.daemon = True
+    timer.start()
+
+
+# lines of the tests output meaning that the tests have failed, used by --fail-fast
+DEFAULT_FAILURE_PATTERNS = (
+    # an API used by the cube has been removed
+    r"^(E\s+)?(ImportError|ModuleNotFoundError)\b",
+    r"ERROR collecting ",
+    # pytest -v and pytest -rfE short summary
+    r"::\S+ (FAILED|ERROR)\b",
+    r"^(FAILED|ERROR) \S+::",
+    # unittest
+    r"^(FAIL|ERROR): \w+ \(",
+)
+# number of lines before the failure displayed when the tests are aborted
+FAILURE_EXCERPT_LINES = 5
+
+
+def run_test_process(test_command, log_file_name, cwd=".", register=None, failure_patterns=(), timeout=None):
+    """ Run the test command, its output going to log_file_name, and returns
+    its return code and, if it has been aborted, why.
+
+    The output is read as soon as it's produced: the tests are aborted (the
+    whole process group is killed) as soon as a line matches one of the
+    failure_patterns (compiled regexes) or after timeout seconds. """
+    test_process = subprocess.Popen(test_command,
+                                    shell=True,
+                                    cwd=cwd,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    # in its own process group to be able to kill its children
+                                    start_new_session=True)
+
+    if register is not None:
+        register(test_process)
+
+    aborted = []
+
+    def abort(reason):
+        if not aborted:
+            aborted.append(reason)
+            _kill_process_tree(test_process)
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, abort, ["timeout after %gs" % timeout])
+        timer.daemon = True
+        timer.start()
+
+    last_lines = []
+
+    try:
+        with open(log_file_name, "wb") as log_file:
+            for line in iter(test_process.stdout.readline, b""):
+                log_file.write(line)
+                log_file.flush()
+
+                if aborted or not failure_patterns:
+                    continue
+
+                decoded_line = line.decode("utf-8", "replace").rstrip()
+                last_lines = (last_lines + [decoded_line])[-FAILURE_EXCERPT_LINES:]
+
+                if any([pattern.search(decoded_line) for pattern in failure_patterns]):
+                    abort("failure detected:\n%s" % "\n".join(["    " + x for x in last_lines]))
+
+        return test_process.wait(), aborted[0] if aborted else None
+    except BaseException:
+        # don't leave the tests running when we are interrupted
+        _kill_process_tree(test_process)
+        raise
+    finally:
+        test_process.stdout.close()
+
+        if timer is not None:
+            timer.cancel()
 
-    for root, dirs, files in os.walk(path):
-        for filename in files:
-            if fnmatch.fnmatch(filename, '__pkginfo__.py'):
-                update_pkginfo(os.path.join(path, filename))
-            if filename not in ftnm:
-                cf.append(filename)
 
-        for dirname in dirs:
-            if dirname not in dtnm:
-                cf.append(dirname)
-        break  # we just need level 1 walk
+def _create_working_copies(number):
+    """ Create 'number' working copies sharing the store of the current repository. """
+    working_copies = []
 
-    with cd(path):
-        for i in cf:
-            command = "hg mv %s %s" % (i, cube_folder)
-            subprocess.Popen(command, shell=True).wait()
+    for _ in range(number):
+        working_copy = tempfile.mkdtemp(prefix="cubetoolkit-")
+        # 'hg share' refuses to create the share in an existing directory
+        os.rmdir(working_copy)
 
-    print_warning('Info: cube files successfully moved into %s' % cube_root)
+        _hg(["--config", "extensions.share=", "share", "--noupdate", "--quiet", os.path.realpath("."), working_copy])
+        working_copies.append(working_copy)
 
+    return working_copies
 
-def replace_cube_file(path, cube_root, filename):
-    """ Delete & replace files that needs to be rewritten using the skeleton. """
 
-    with cd(path):
-        command = "hg rm %s" % filename
-        subprocess.Popen(command, shell=True).wait()
+def _pick_versions_to_test(lowest, highest, number, strategy):
+    """ Returns up to 'number' indexes of versions to test in [lowest, highest]. """
+    if number <= 0 or lowest > highest:
+        return []
 
-        url = "https://hg.logilab.org/master/cubicweb/raw-file/tip/cubicweb/skeleton/%s.tmpl" % filename
-        context = {'cubename': cube_root, 'distname': 'cubicweb-' + cube_root}
-        response = requests.get(url)
-        with open(filename, 'w') as out:
-            template = response.content.decode()
-            out.write(template % context)
+    if strategy == "linear":
+        return list(range(lowest, min(lowest + number, highest + 1)))
 
-            command = "hg add %s" % filename
-            subprocess.Popen(command, shell=True).wait()
-            print_warning('Info: %s successfully updated' % filename)
+    # split the range in number + 1 parts of the same size
+    size = highest - lowest + 1
+    return sorted(set([lowest + (size * (i + 1)) // (number + 1) for i in range(min(number, size))]))
 
 
-def remove_useless_files(cube_root):
-    """ Remove all the files that are no more used. """
+def _update_search_range(results, best, lowest, highest, latest):
+    """ Returns (best, lowest, highest) once the versions of results
+    ({index: result}) have been tested: best is the index of the highest
+    version known to be working, [lowest, highest] the range of indexes still
+    worth testing. A failure is assumed to fail for all the versions after it,
+    cancelled tests (success is None) don't tell anything. """
+    failures = [index for index in results if results[index]["success"] is False]
+    first_failure = min(failures) if failures else latest + 1
+    successes = [index for index in results if results[index]["success"] and index < first_failure]
 
-    with cd(cube_root):
-        for filename in ['apycot.ini', 'pytestconf.py']:
-            command = "hg rm %s" % filename
-            subprocess.Popen(command, shell=True).wait()
-            print_warning('Info: %s successfully removed' % filename)
+    if successes and (best is None or max(successes) > best):
+        best = max(successes)
+        lowest = best + 1
 
+    return best, lowest, min(highest, first_failure - 1)
 
-def fix_unittest_import(path, filename):
-    """ Make sure we use unittest from standard lib."""
-    with cd(path):
-        content = []
-        with open(filename, 'r') as f:
-            content = f.readlines()
 
-        with open(filename, 'w') as f:
-            for line in content:
-                if "unittest_main" in line:
-                    line = re.sub(r"^from logilab\.common\.testlib import unittest_main$", r"import unittest", line)
-                    line = re.sub(r"^    from logilab\.common\.testlib import unittest_main$", r"    import unittest", line)
-                    line = re.sub(r"^    unittest_main\(\)$", "    unittest.main()", line)
-                f.write(line)
+def _isolate_culprits(depend_keys, test):
+    """ Test all the dependencies at once with test(keys), a function
+    returning a test result. If it fails, the culprits are isolated by
+    splitting the dependencies in two halves, recursively: a half passing the
+    tests (with the dependencies already accepted) is accepted.
 
+    Returns (accepted, culprits, result of the last successful test). This
+    costs one test run if everything works and about 2 * log2(N) runs per
+    culprit otherwise. """
+    accepted = []
+    culprits = []
+    last_success = {}
 
-def fix_cube_import(cube_root, filename):
-    """ Make sure we import cube using new layout."""
-    with cd(cube_root):
-        content = []
-        with open(filename, 'r') as f:
-            content = f.readlines()
+    def search(group, known_to_fail=False):
+        if not known_to_fail:
+            result = test(accepted + group)
 
-        with open(filename, 'w') as f:
-            for line in content:
-                if "cubes." in line:
-                    line = re.sub(r"", r"", line)
-                    f.write(line)
+        if not known_to_fail and result["success"]:
+            accepted.extend(group)
+            last_success.clear()
+            last_success.update(result)
+            return
 
+        if len(group) == 1:
+            print("%s breaks the tests, it will be upgraded on its own" % group[0])
+            culprits.append(group[0])
+            return
 
-def to_newstyle_cube(path):
-    "Upgrade oldstyle CW cube to newstyle"
-    path = os.path.realpath(os.path.expanduser(path))
+        number_of_culprits = len(culprits)
+        search(group[:len(group) // 2])
 
-    if not os.path.exists(path):
-        print("Error: '%s' doesn't exist" % path)
-        sys.exit(1)
+        # if the first half has been accepted, the tests of the second one
+        # with it are the ones that have just failed
+        search(group[len(group) // 2:], known_to_fail=len(culprits) == number_of_culprits)
 
-    cube_root = os.path.basename(path)
-    cube_folder = 'cubicweb_%s' % cube_root
+    search(list(depend_keys))
 
-    # setup.py and MANIFEST.in can just be replaced
-    for i in ['setup.py', 'MANIFEST.in', 'tox.ini']:
-        replace_cube_file(path, cube_root, i)
+    return accepted, culprits, last_success
 
-    create_cube_folder(path, cube_root, cube_folder)
-    move_cube_files(path, cube_root, cube_folder)
 
-    py_files = _get_python_files(path)
-    # remove_useless_files
+def _test_outcome_key(depends, node, test_command):
+    """ Returns the key of a test run of this whole __depends__ dict on this
+    revision with this test command. """
+    return hashlib.sha1(json.dumps([sorted(depends.items()), node, test_command]).encode()).hexdigest()
 
-    for f in py_files:
-        fix_unittest_import(path, f)
-        # fix_cubes_import
-        # automatically call autopep8?
 
+def _open_test_outcomes_database():
+    import sqlite3
 
-def find_pkginfo(path):
-    dirs = os.listdir(path)
+    if not os.path.exists(CACHE_PATH):
+        os.makedirs(CACHE_PATH, exist_ok=True)
 
-    if "__pkginfo__.py" in dirs:
-        return os.path.join(path, "__pkginfo__.py")
+    connection = sqlite3.connect(os.path.join(CACHE_PATH, TEST_OUTCOMES_DATABASE_NAME), timeout=30)
+    connection.execute("CREATE TABLE IF NOT EXISTS test_outcomes "
+                       "(key TEXT PRIMARY KEY, success INTEGER, log_file_name TEXT, date REAL)")
 
-    cube_subdirs = [os.path.join(path, x) for x in dirs if os.path.isdir(x) and x.startswith("cubicweb_")]
+    return connection
 
-    if not cube_subdirs:
-        print("Couldn't find the __pkginfo__.py file :(")
-        sys.exit(1)
 
-    for subdir in cube_subdirs:
-        if "__pkginfo__.py" in os.listdir(subdir):
-            return os.path.join(subdir, "__pkginfo__.py")
+def get_test_outcome(key):
+    """ Returns the previously stored result of a test run, or None. """
+    connection = _open_test_outcomes_database()
 
-    print("Couldn't find the __pkginfo__.py file :(")
-    sys.exit(1)
+    try:
+        row = connection.execute("SELECT success, log_file_name FROM test_outcomes WHERE key = ?", (key,)).fetchone()
+    finally:
+        connection.close()
 
+    if row is None:
+        return None
 
-def parse_pkginfo(path):
-    red = RedBaron(open(path, "r").read())
+    return {"success": bool(row[0]), "log_file_name": row[1], "cached": True}
 
-    depends = red.find("assign", lambda x: x.target.value == "__depends__")
 
-    if not depends:
-        print("I couldn't find __depends__ in the __pkginfo__.py :(")
-        sys.exit(1)
+def store_test_outcome(key, result):
+    connection = _open_test_outcomes_database()
 
-    assert depends.value.type == "dict"
+    try:
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO test_outcomes VALUES (?, ?, ?, ?)",
+                               (key, int(result["success"]), result["log_file_name"], time.time()))
+    finally:
+        connection.close()
 
-    # oupsi I'm lazy, it's bad :(
-    # XXX use to_python() somehow
-    return eval(depends.value.dumps()), red, depends
 
+_journal_lock = threading.Lock()
 
-def merge_depends_with_pypi_info(depends):
-    new_depends = {}
 
-    for key, value in depends.items():
-        pkg_name = key.split("[", 1)[0]
+def append_to_journal(session, entry):
+    """ Append an entry to the journal of the session, it's written on the
+    disk right away to survive the death of the process. """
+    path = os.path.join(SESSIONS_PATH, session, JOURNAL_NAME)
 
-        print("Get all releases of %s..." % pkg_name)
-        response = requests.get("https://pypi.org/pypi/%s/json" % pkg_name, timeout=30)
-        if response.status_code == 404:
-            print("Warning: %s doesn't exist on pypi, skip it" % pkg_name)
-            continue
+    with _journal_lock:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
 
-        data = response.json()
+        with open(path, "a") as journal:
+            journal.write(json.dumps(dict(entry, date=time.time())) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
 
-        all_versions = []
 
-        for key2, value2 in data["releases"].items():
-            # sometime we don't have metadata information for a release :|
-            all_versions.append(value2[0] if value2 else {})
-            all_versions[-1]["version"] = key2
+def read_journal(session):
+    """ Returns the entries of the journal of the session, an entry being
+    written when the process was killed is ignored. """
+    path = os.path.join(SESSIONS_PATH, session, JOURNAL_NAME)
 
-        new_depends[key] = {
-            "pkg_name": pkg_name,
-            "current_version_scheme": value,
-            "all_versions": all_versions
-        }
+    if not os.path.exists(path):
+        return []
 
-    return new_depends
+    entries = []
 
+    with open(path, "r") as journal:
+        for line in journal:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                print("Warning: ignore a truncated entry of %s" % path)
 
-def filter_pkg_that_can_be_upgraded(depends):
-    no_upgrades = []
-    new_depends = {}
+    return entries
 
-    for key, value in depends.items():
-        conditions = parse_conditions(value["current_version_scheme"])
 
-        if conditions is None:
-            print("No specified version for %s, drop it" % key)
-            continue
+def find_session_to_resume():
+    """ Returns the most recent session that hasn't been finished, or None. """
+    if not os.path.isdir(SESSIONS_PATH):
+        return None
 
-        value["all_versions"] = [version for version in value["all_versions"] if not set(string.ascii_letters).intersection(version["version"])]
+    # sessions are named after their start time
+    for session in sorted(os.listdir(SESSIONS_PATH), reverse=True):
+        entries = read_journal(session)
 
-        compatible_versions = value["all_versions"]
+        if entries and not [x for x in entries if x["event"] == "end"]:
+            return session
 
-        for (op, version) in conditions:
-            compatible_versions = [x for x in compatible_versions if op(LooseVersion(x["version"]), LooseVersion(version))]
+    return None
 
-        maximum_version = list(sorted(compatible_versions, key=lambda x: LooseVersion(x["version"])))[-1]
-        all_versions_sorted = sorted(value["all_versions"], key=lambda x: LooseVersion(x["version"]))
-        possible_upgrades = list(itertools.dropwhile(lambda x: LooseVersion(x["version"]) <= LooseVersion(maximum_version["version"]), all_versions_sorted))
 
-        if possible_upgrades:
-            new_depends[key] = value
-            new_depends[key]["possible_upgrades"] = possible_upgrades
-        else:
-            no_upgrades.append(key)
+def revert_session_changes(pkginfo_path):
+    """ Revert the files an interrupted session may have left modified in the
+    repository: the __pkginfo__.py and the files using old style cube imports
+    that were being rewritten. Other changes are left untouched. """
+    root = _find_hg_root()
+    to_revert = []
 
-    if no_upgrades:
-        print("Skipped packages that don't need to be upgraded: %s" % (", ".join(no_upgrades)))
+    for name in _hg(["status", "--modified", "--no-status"]).splitlines():
+        file_path = os.path.join(root, name)
 
-    if new_depends:
-        print("")
-        print("Packages that can upgrades with all those available verisons:")
-        for key, value in new_depends.items():
-            print("* %s (%s) to %s" % (key, value["current_version_scheme"], ", ".join([x["version"] for x in value["possible_upgrades"]])))
+        if os.path.realpath(file_path) == os.path.realpath(pkginfo_path):
+            to_revert.append(file_path)
+        elif _find_imported_cubes(_hg(["cat", "-r", ".", file_path])):
+            to_revert.append(file_path)
 
-    return new_depends
+    for file_path in to_revert:
+        print("* revert %s" % os.path.relpath(file_path))
 
+    if to_revert:
+        _hg(["revert", "--no-backup"] + to_revert)
 
-def parse_conditions(conditions):
-    string_to_operator = {
-        "==": operator.eq,
-        "<": operator.lt,
-        "<=": operator.le,
-        "!=": operator.ne,
-        ">=": operator.ge,
-        ">": operator.gt,
-    }
 
-    parsed_conditions = []
+def try_to_upgrade_dependencies(test_command, depends, pkginfo_path, pkginfo, current_depends, strategy="bisect", jobs=1,
+                                use_test_cache=True, session=None, optimistic=False, failure_patterns=(), test_timeout=None):
+    """ Upgrade each dependency to its highest working version and commit it.
 
-    if not conditions:
-        return None
+    If optimistic is True, all the dependencies are first upgraded to their
+    latest version at once, see upgrade_optimistically.
 
-    for i in conditions.split(","):
-        version_operator, version_number = re.match("(==|>=|<=|>|<) *([0-9.]*)", i.strip()).groups()
+    Tests are aborted as soon as a line of their output matches one of the
+    failure_patterns or after test_timeout seconds.
 
-        parsed_conditions.append([
-            string_to_operator[version_operator],
-            version_number,
-        ])
+    Every test result and upgrade decision is written in the journal of the
+    session, if session is the name of an interrupted session it's resumed:
+    dependencies already done are skipped and the test results of the
+    journal are reused. """
+    # current_depends is the content of __depends__ with the upgrades done so far
+    current_depends = dict(current_depends)
+    compiled_failure_patterns = [re.compile(x) for x in failure_patterns]
 
-    return parsed_conditions
+    def with_version(depend_key, value):
+        """ Returns a copy of current_depends with this version of depend_key """
+        return dict(current_depends, **{depend_key: "== %s" % value})
 
+    def set_version(depend_key, value):
+        current_depends[depend_key] = "== %s" % value
 
-def try_to_upgrade_dependencies(test_command, depends, pkginfo_path, red, red_depends):
-    def change_dependency_version_on_disk(entry, value):
-        entry.value = ("'== %s'" % value)
+        return render_pkginfo(pkginfo, current_depends)
 
-        dumps = red.dumps()
-        with open(pkginfo_path, "w") as pkginfo_file:
-            pkginfo_file.write(dumps)
+    def write_pkginfo(content, path="."):
+        with open(os.path.join(path, pkginfo_relative_path), "w") as pkginfo_file:
+            pkginfo_file.write(content)
 
     def hg_commit(key, before, after):
         commit_message = "[enh] upgrade %s from '%s' to '== %s'" % (key, before, after)
-        hg_commit_command = "hg commit -m \"%s\"" % commit_message
-        print(hg_commit_command)
-        subprocess.check_call(hg_commit_command, shell=True)
+        print("hg commit -m \"%s\"" % commit_message)
+        _hg(["commit", "-m", commit_message])
 
         return commit_message
 
-    def launch_test_command(test_command, depend_key, before, after):
+    @traced("tests")
+    def launch_test_command(test_command, depend_key, before, after, cwd=".", register=None):
         print("starting test process '%s'..." % test_command)
-        log_file_name = "autoupgradedependencies/%s/upgrade_%s_from_%s_to_%s.log" % (session_start_time,
-                                                                                     depend_key, before, after)
+        log_file_name = "%s/%s/upgrade_%s_from_%s_to_%s.log" % (SESSIONS_PATH, session_start_time,
+                                                                 depend_key, before, after)
         log_file_name = log_file_name.replace(" ", "")
 
         directory = os.path.split(log_file_name)[0]
@@ -423,53 +1832,250 @@ def try_to_upgrade_dependencies(test_command, depends, pkginfo_path, red, red_de
         log_file_name = os.path.realpath(log_file_name)
 
         if not os.path.exists(directory):
-            os.makedirs(directory)
+            os.makedirs(directory, exist_ok=True)
 
         print("logging command output in %s" % log_file_name)
-        test_process = subprocess.Popen(test_command,
-                                        shell=True,
-                                        bufsize=0,
-                                        stdout=open(log_file_name, "w"),
-                                        stderr=subprocess.STDOUT)
+        return_code, aborted = run_test_process(test_command, log_file_name, cwd=cwd, register=register,
+                                                failure_patterns=compiled_failure_patterns, timeout=test_timeout)
 
-        # will return return_code
-        return test_process.wait(), log_file_name
+        if aborted:
+            print("tests of %s %s aborted, %s" % (depend_key, after, aborted))
 
-    def change_cubes_import_if_needed(cube_name, version_metadata):
-        if "url" not in version_metadata:
-            print("Warning: there is no distributions files for %s version %s, I can't check if the cube format has changed" % (version_metadata["version"]))
+        return return_code, log_file_name, aborted
 
+    def change_cubes_import_if_needed(cube_name, version_metadata, path="."):
         cube_name = cube_name.split("-")[1]
 
-        url = version_metadata["url"]
-
-        archive = tarfile.open(fileobj=requests.get(url, stream=True).raw, mode="r|*")
-
-        directories = [x.name.split("/", 1)[1] for x in archive.getmembers() if x.isdir() and "/" in x.name]
-
         # this is still the old format
-        if ("cubicweb_%s" % cube_name) not in directories:
+        if not is_new_style_cube_release(cube_name, version_metadata):
             print("(cube %s is still in old format)" % cube_name)
             return
 
-        pattern = "from cubes.%s" % cube_name
+        rewrite_cube_imports(cube_name, path)
+
+    def apply_version(depend_key, version_metadata):
+        write_pkginfo(set_version(depend_key, version_metadata["version"]))
+
+        if depend_key.startswith("cubicweb-"):
+            change_cubes_import_if_needed(depend_key, version_metadata)
+
+    def run_test(depend_key, version_metadata, pkginfo_content, initial_version_scheme, path=".", register=None):
+        version = version_metadata["version"]
+
+        print("")
+        print("trying %s to %s" % (depend_key, version))
+        write_pkginfo(pkginfo_content, path)
+
+        if depend_key.startswith("cubicweb-"):
+            change_cubes_import_if_needed(depend_key, version_metadata, path)
+
+        return_code, log_file_name, aborted = launch_test_command(test_command, depend_key, initial_version_scheme,
+                                                                  version, cwd=path, register=register)
+
+        return {
+            "version": version,
+            "success": return_code == 0 and not aborted,
+            "log_file_name": log_file_name,
+            "aborted": aborted,
+        }
+
+    def is_timeout(result):
+        # it could pass with a longer timeout, don't keep it in the tests cache
+        return (result.get("aborted") or "").startswith("timeout")
+
+    def print_result(depend_key, result):
+        if result["success"]:
+            print("Success on %s for version %s!" % (depend_key, result["version"]))
+        elif result["success"] is None:
+            print("(test of %s %s has been cancelled)" % (depend_key, result["version"]))
+        else:
+            print("Failure when upgrading %s to %s" % (depend_key, result["version"]))
+
+    def test_versions(depend_key, possible_upgrades, indexes, initial_version_scheme):
+        """ Test the versions at those indexes and returns their results by index.
+
+        Results already known by the tests cache aren't run again. With
+        several jobs, versions are tested at the same time in their own
+        working copy. As soon as a version fails (or works) the tests of the
+        versions after it (or before it) are cancelled since their result
+        doesn't matter anymore, their success is None. """
+        node = _hg(["log", "-r", ".", "-T", "{node}"]).strip()
+
+        # candidates are rendered from copies, current_depends only changes
+        # once the version of depend_key is chosen
+        contents = {}
+        cache_keys = {}
+
+        for index in indexes:
+            candidate_depends = with_version(depend_key, possible_upgrades[index]["version"])
+            contents[index] = render_pkginfo(pkginfo, candidate_depends)
+            cache_keys[index] = _test_outcome_key(candidate_depends, node, test_command)
+
+        results = {}
+
+        for index in indexes:
+            if cache_keys[index] in journal_outcomes:
+                results[index] = dict(journal_outcomes[cache_keys[index]], version=possible_upgrades[index]["version"])
+                print("")
+                print("(result of %s %s from the session journal)" % (depend_key, results[index]["version"]))
+                print_result(depend_key, results[index])
+                continue
+
+            outcome = get_test_outcome(cache_keys[index]) if use_test_cache else None
+
+            if outcome is None:
+                continue
+
+            test_cache_stats["hits"] += 1
+            results[index] = dict(outcome, version=possible_upgrades[index]["version"])
+            print("")
+            print("(result of %s %s from the tests cache)" % (depend_key, results[index]["version"]))
+            print_result(depend_key, results[index])
+
+        def is_still_needed(index):
+            for other_index, result in results.items():
+                if (result["success"] and index < other_index) or (result["success"] is False and index > other_index):
+                    return False
+
+            return True
+
+        def store_result(index, result):
+            if result["success"] is None:
+                return
+
+            append_to_journal(session_start_time, {
+                "event": "test",
+                "dependency": depend_key,
+                "key": cache_keys[index],
+                "result": result,
+            })
+
+            if use_test_cache and not is_timeout(result):
+                store_test_outcome(cache_keys[index], result)
+
+        if jobs <= 1:
+            for index in indexes:
+                if index in results or not is_still_needed(index):
+                    continue
+
+                test_cache_stats["misses"] += 1
+                results[index] = run_test(depend_key, possible_upgrades[index], contents[index], initial_version_scheme)
+                print_result(depend_key, results[index])
+                store_result(index, results[index])
+
+                if results[index]["success"]:
+                    main_checkout["version"] = results[index]["version"]
+                else:
+                    _hg(["revert", "-a", "--no-backup"])
+                    main_checkout["version"] = None
+
+            return results
+
+        to_test = [index for index in indexes if index not in results and is_still_needed(index)]
+
+        if not to_test:
+            return results
+
+        if not working_copies:
+            print("")
+            print("Create %s working copies to run tests in parallel..." % jobs)
+            for working_copy in _create_working_copies(jobs):
+                working_copies.append(working_copy)
+                available_working_copies.put(working_copy)
+
+        lock = threading.Lock()
+        processes = {}
+        cancelled = set()
+
+        def register(index, process):
+            with lock:
+                processes[index] = process
+
+                if index in cancelled:
+                    _kill_process_tree(process)
+
+        def cancel(index):
+            with lock:
+                cancelled.add(index)
+
+                if index in processes:
+                    _kill_process_tree(processes[index])
+
+        def test_in_working_copy(index):
+            working_copy = available_working_copies.get()
+
+            try:
+                if index in cancelled:
+                    return None
+
+                _hg(["update", "--clean", "--quiet", "-r", node], working_copy)
+
+                result = run_test(depend_key, possible_upgrades[index], contents[index], initial_version_scheme,
+                                  path=working_copy, register=functools.partial(register, index))
+            finally:
+                available_working_copies.put(working_copy)
+
+            if index in cancelled:
+                result["success"] = None
+
+            print_result(depend_key, result)
+            store_result(index, result)
+
+            return result
 
-        # lazy way for now, should use redbaron
-        for python_file in _get_python_files():
-            with open(python_file, "r") as text:
-                text = text.read()
+        futures = dict((executor.submit(test_in_working_copy, index), index) for index in to_test)
 
-                if pattern in text:
-                    with open(python_file, "w") as to_modify:
-                        print("* change import to new format for cube %s in %s" % (cube_name, python_file))
-                        text = text.replace(pattern, "from cubicweb_%s" % cube_name)
-                        to_modify.write(text)
+        for future in as_completed(futures):
+            index = futures[future]
+
+            if future.cancelled() or future.result() is None:
+                results[index] = {"version": possible_upgrades[index]["version"], "success": None, "log_file_name": None}
+                continue
+
+            test_cache_stats["misses"] += 1
+            results[index] = future.result()
+
+            if results[index]["success"] is None:
+                continue
+
+            for other_future, other_index in futures.items():
+                if not is_still_needed(other_index):
+                    other_future.cancel()
+                    cancel(other_index)
+
+        return results
 
     # start with cubes
     cubes = filter(lambda x: x[0].startswith("cubicweb-"), depends.items())
     not_cubes = filter(lambda x: not x[0].startswith("cubicweb-"), depends.items())
 
-    session_start_time = datetime.now().strftime("%F-%X")
+    session_start_time = session or datetime.now().strftime("%F-%X")
+    journal = read_journal(session) if session else []
+
+    # test results of the session, by tests cache key
+    journal_outcomes = dict((x["key"], x["result"]) for x in journal if x["event"] == "test")
+    done_dependencies = [x["dependency"] for x in journal if x["event"] == "done"]
+
+    if not session:
+        append_to_journal(session_start_time, {
+            "event": "start",
+            "test_command": test_command,
+            "strategy": strategy,
+            "depends": current_depends,
+        })
+    pkginfo_relative_path = os.path.relpath(pkginfo_path)
+
+    # version of the dependency being upgraded that is on disk in the main checkout
+    main_checkout = {"version": None}
+
+    working_copies = []
+    available_working_copies = queue.Queue()
+    executor = ThreadPoolExecutor(max_workers=jobs)
+
+    test_cache_stats = {
+        "hits": 0,
+        "misses": 0,
+    }
 
     summary = {
         "full_success": [],
@@ -478,119 +2084,210 @@ def try_to_upgrade_dependencies(test_command, depends, pkginfo_path, red, red_de
         "commits": [],
     }
 
-    for depend_key, depend_data in itertools.chain(cubes, not_cubes):
-        is_a_cube = depend_key.startswith("cubicweb-")
+    # what has been done before the session has been interrupted
+    for entry in journal:
+        if entry["event"] == "done":
+            summary[entry["outcome"]].append(entry["summary"])
+
+            if entry.get("commit"):
+                summary["commits"].append(entry["commit"])
 
-        entry = red_depends.value.filter(lambda x: hasattr(x, "key") and x.key.to_python() == depend_key)[0]
+    def done(depend_key, outcome, summary_entry, commit=None):
+        summary[outcome].append(summary_entry)
 
-        initial_value = entry.value.copy()
+        if commit:
+            summary["commits"].append(commit)
 
-        max_possible_value = depend_data["possible_upgrades"][-1]["version"]
+        append_to_journal(session_start_time, {
+            "event": "done",
+            "dependency": depend_key,
+            "outcome": outcome,
+            "summary": summary_entry,
+            "commit": commit,
+        })
+
+    def test_group(group):
+        """ Test the latest version of all the dependencies of group at once,
+        the other ones keep their current version. Returns the test result. """
+        upgraded_depends = dict(current_depends)
+
+        for depend_key in group:
+            upgraded_depends[depend_key] = "== %s" % depends[depend_key]["possible_upgrades"][-1]["version"]
+
+        node = _hg(["log", "-r", ".", "-T", "{node}"]).strip()
+        key = _test_outcome_key(upgraded_depends, node, test_command)
+        outcome = journal_outcomes.get(key) or (get_test_outcome(key) if use_test_cache else None)
 
         print("")
-        print("Upgrading %s to %s" % (depend_key, max_possible_value))
-        change_dependency_version_on_disk(entry, max_possible_value)
+        print("trying the latest version of %s" % ", ".join(group))
 
-        if is_a_cube:
-            change_cubes_import_if_needed(depend_key, depend_data["possible_upgrades"][-1])
+        if key in journal_outcomes:
+            print("(result from the session journal)")
+        elif outcome is not None:
+            print("(result from the tests cache)")
+            test_cache_stats["hits"] += 1
 
-        pid, log_file_name = launch_test_command(test_command, depend_key, initial_value.to_python(), max_possible_value)
-        if pid == 0:
-            print("Success for upgrading %s to %s!" % (depend_key, max_possible_value))
-            summary["commits"].append(hg_commit(depend_key, initial_value.to_python(), max_possible_value))
+        if outcome is not None:
+            print("Success!" if outcome["success"] else "Failure")
+            return outcome
 
-            summary["full_success"].append({
-                "dependency": depend_key,
-                "from": initial_value.to_python(),
-                "to": max_possible_value,
-                "log_file_name": log_file_name,
-            })
+        test_cache_stats["misses"] += 1
+
+        write_pkginfo(render_pkginfo(pkginfo, upgraded_depends))
+
+        for depend_key in group:
+            if depend_key.startswith("cubicweb-"):
+                change_cubes_import_if_needed(depend_key, depends[depend_key]["possible_upgrades"][-1])
+
+        # named after the test key, a resumed session doesn't overwrite the logs of the interrupted one
+        return_code, log_file_name, aborted = launch_test_command(test_command, "optimistic_%s" % key[:12],
+                                                                  "current", "latest")
+        _hg(["revert", "-a", "--no-backup"])
+
+        result = {"success": return_code == 0 and not aborted, "log_file_name": log_file_name, "aborted": aborted}
+        print("Success!" if result["success"] else "Failure")
+
+        append_to_journal(session_start_time, {
+            "event": "test",
+            "dependency": ", ".join(group),
+            "key": key,
+            "result": result,
+        })
+
+        if use_test_cache and not is_timeout(result):
+            store_test_outcome(key, result)
+
+        return result
 
-        elif len(depend_data["possible_upgrades"]) > 1:
-            print("Failure when upgrading %s to %s, switch to version per version strategy" % (depend_key, max_possible_value))
+    def upgrade_optimistically(depend_keys):
+        """ Test the latest version of all the dependencies at once and
+        isolate the ones breaking the tests, see _isolate_culprits. Upgrades of
+        the accepted dependencies are committed, the culprits are returned to
+        be upgraded one by one. """
+        print("")
+        print("Optimistic upgrade of %s dependencies at once" % len(depend_keys))
+        accepted, culprits, last_success = _isolate_culprits(depend_keys, test_group)
+
+        for depend_key in accepted:
+            latest = depends[depend_key]["possible_upgrades"][-1]
+            initial_version_scheme = current_depends[depend_key]
 
-            subprocess.check_call("hg revert -a --no-backup", shell=True)
+            # all the accepted upgrades have been tested together
+            apply_version(depend_key, latest)
 
-            previous_version = None
-            previous_version_metadata = None
+            done(depend_key, "full_success", {
+                "dependency": depend_key,
+                "from": initial_version_scheme,
+                "to": latest["version"],
+                "log_file_name": last_success["log_file_name"],
+                "tested": [{"version": latest["version"], "success": True, "log_file_name": last_success["log_file_name"],
+                            "cached": last_success.get("cached", False)}],
+            }, hg_commit(depend_key, initial_version_scheme, latest["version"]))
 
-            for number, version_metadata in enumerate(depend_data["possible_upgrades"][:-1]):
-                version = version_metadata["version"]
+        return culprits
 
+    try:
+        for depend_key in done_dependencies:
+            if depend_key in depends:
                 print("")
-                print("trying %s to %s" % (depend_key, version))
-                change_dependency_version_on_disk(entry, version)
+                print("(%s has already been done in this session, skip it)" % depend_key)
 
-                if is_a_cube:
-                    change_cubes_import_if_needed(depend_key, version_metadata)
+        to_upgrade = [x for x in itertools.chain(cubes, not_cubes) if x[0] not in done_dependencies]
 
-                pid, log_file_name = launch_test_command(test_command, depend_key, initial_value.to_python(), version)
-                if pid == 0:
-                    print("Success on %s for version %s! Continue to next version" % (depend_key, version))
-                    previous_version = version
-                    previous_version_metadata = version_metadata
-                elif previous_version:
-                    print("Failure when upgrading %s to %s, %s is the maximum upgradable version" % (depend_key, version, previous_version))
+        if optimistic and len(to_upgrade) > 1:
+            culprits = upgrade_optimistically([depend_key for depend_key, _ in to_upgrade])
+            to_upgrade = [x for x in to_upgrade if x[0] in culprits]
 
-                    change_dependency_version_on_disk(entry, previous_version)
+        for depend_key, depend_data in to_upgrade:
+            initial_version_scheme = current_depends[depend_key]
+            main_checkout["version"] = None
 
-                    if is_a_cube:
-                        change_cubes_import_if_needed(depend_key, previous_version_metadata)
+            possible_upgrades = depend_data["possible_upgrades"]
+            latest = len(possible_upgrades) - 1
+            tested = []
 
-                    summary["commits"].append(hg_commit(depend_key, initial_value.to_python(), version))
+            # index of the highest version known to be working
+            best = None
 
-                    summary["partial_success"].append({
-                        "dependency": depend_key,
-                        "from": initial_value.to_python(),
-                        "to": version,
-                        "log_file_name": log_file_name,
-                        "possible_upgrades": depend_data["possible_upgrades"][number:],
-                    })
+            # range of the versions that still need to be tested, we assume that
+            # if a version fails all the versions after it fail too
+            lowest, highest = 0, latest - 1
 
-                    break
-                else:
-                    print("Failure when upgrading %s to any version, it's not upgradable :(" % (depend_key))
+            # always start by trying the latest version, with several jobs other
+            # versions are tested at the same time in case it fails
+            indexes = [latest] + _pick_versions_to_test(lowest, highest, jobs - 1, strategy)
 
-                    entry.value = initial_value
-                    subprocess.check_call("hg revert -a --no-backup", shell=True)
+            while indexes:
+                results = test_versions(depend_key, possible_upgrades, indexes, initial_version_scheme)
+                tested.extend([results[index] for index in sorted(results)])
 
-                    summary["total_failure"].append({
-                        "dependency": depend_key,
-                        "from": initial_value.to_python(),
-                        "log_file_name": log_file_name,
-                        "possible_upgrades": depend_data["possible_upgrades"],
-                    })
+                failures = [index for index in results if results[index]["success"] is False]
+                best, lowest, highest = _update_search_range(results, best, lowest, highest, latest)
 
+                if best == latest:
                     break
-            # we haven't break
-            # yes this python syntaxe is horrible
-            else:
-                print("Actually it's the last compatible versions before the buggy %s" % max_possible_value)
-                # should already be done
-                # change_dependency_version_on_disk(entry, previous_version)
 
-                summary["commits"].append(hg_commit(depend_key, initial_value.to_python(), version))
+                if latest in failures and lowest <= highest:
+                    print("Failure when upgrading %s to %s, switch to %s strategy" % (depend_key, possible_upgrades[-1]["version"], strategy))
+
+                indexes = _pick_versions_to_test(lowest, highest, jobs, strategy)
 
-                summary["partial_success"].append({
+            tested = [x for x in tested if x["success"] is not None]
+
+            if best is None:
+                print("Failure when upgrading %s to any version, it's not upgradable :(" % (depend_key))
+                current_depends[depend_key] = initial_version_scheme
+
+                done(depend_key, "total_failure", {
                     "dependency": depend_key,
-                    "from": initial_value.to_python(),
-                    "to": version,
-                    "log_file_name": log_file_name,
-                    "possible_upgrades": depend_data["possible_upgrades"][-1:],
+                    "from": initial_version_scheme,
+                    "log_file_name": tested[-1]["log_file_name"],
+                    "possible_upgrades": possible_upgrades,
+                    "tested": tested,
                 })
 
-        else:
-            print("Failure when upgrading %s to %s, fail back to previous value :(" % (depend_key, max_possible_value))
-            entry.value = initial_value
+                continue
 
-            subprocess.check_call("hg revert -a --no-backup", shell=True)
+            best_version = possible_upgrades[best]["version"]
+            best_log_file_name = [x for x in tested if x["version"] == best_version][0]["log_file_name"]
 
-            summary["total_failure"].append({
-                "dependency": depend_key,
-                "from": initial_value.to_python(),
-                "log_file_name": log_file_name,
-                "possible_upgrades": [],
-            })
+            # tests have been run in other working copies, taken from the
+            # cache or a failing version has been tested after it
+            if main_checkout["version"] != best_version:
+                apply_version(depend_key, possible_upgrades[best])
+            else:
+                current_depends[depend_key] = "== %s" % best_version
+
+            commit = hg_commit(depend_key, initial_version_scheme, best_version)
+
+            if best == latest:
+                print("Success for upgrading %s to %s!" % (depend_key, best_version))
+
+                done(depend_key, "full_success", {
+                    "dependency": depend_key,
+                    "from": initial_version_scheme,
+                    "to": best_version,
+                    "log_file_name": best_log_file_name,
+                    "tested": tested,
+                }, commit)
+            else:
+                print("%s is the maximum upgradable version of %s" % (best_version, depend_key))
+
+                done(depend_key, "partial_success", {
+                    "dependency": depend_key,
+                    "from": initial_version_scheme,
+                    "to": best_version,
+                    "log_file_name": best_log_file_name,
+                    "possible_upgrades": possible_upgrades[best + 1:],
+                    "tested": tested,
+                }, commit)
+
+        append_to_journal(session_start_time, {"event": "end"})
+    finally:
+        executor.shutdown()
+
+        for working_copy in working_copies:
+            shutil.rmtree(working_copy, ignore_errors=True)
 
     print("")
     print("Summary of execution")
@@ -607,7 +2304,7 @@ def try_to_upgrade_dependencies(test_command, depends, pkginfo_path, red, red_de
         print("")
         print("Upgraded to a more up to date version but fail to upgrade to the latest one:")
 
-        for i in summary["full_success"]:
+        for i in summary["partial_success"]:
             print("* %s from '%s' to %s, newest versions: [%s], log: %s" % (i["dependency"],
                                                                             i["from"], i["to"],
                                                                             ", ".join([x["version"] for x in i["possible_upgrades"]]),
@@ -622,6 +2319,20 @@ def try_to_upgrade_dependencies(test_command, depends, pkginfo_path, red, red_de
                                                               ", ".join([x["version"] for x in i["possible_upgrades"]]),
                                                               i["log_file_name"]))
 
+    tested_dependencies = summary["full_success"] + summary["partial_success"] + summary["total_failure"]
+
+    print("")
+    print("Tested versions (%s test runs):" % sum([len(i["tested"]) for i in tested_dependencies]))
+    for i in tested_dependencies:
+        print("* %s: %s" % (i["dependency"], ", ".join(["%s (%s%s%s)" % (x["version"], "ok" if x["success"] else "failed",
+                                                                          ", aborted" if x.get("aborted") else "",
+                                                                          ", cached" if x.get("cached") else "")
+                                                        for x in i["tested"]])))
+
+    if use_test_cache:
+        print("")
+        print("Tests cache: %s hits, %s misses" % (test_cache_stats["hits"], test_cache_stats["misses"]))
+
     print("")
     if summary["commits"]:
         print("Generated commits:")
@@ -631,24 +2342,73 @@ def try_to_upgrade_dependencies(test_command, depends, pkginfo_path, red, red_de
         print("Not commits.")
 
     print("")
-    print("All log files are located in %s" % os.path.split(log_file_name)[0])
+    print("All log files are located in %s" % os.path.realpath(os.path.join(SESSIONS_PATH, session_start_time)))
+
+    print_trace_timings()
+
+
+@argh.arg("--strategy", choices=["bisect", "linear"],
+          help="how to find the highest working version when the latest one fails: "
+               "binary search or trying versions one by one from the oldest one")
+@argh.arg("-j", "--jobs", help="number of versions tested at the same time, each one in its own working copy")
+@argh.arg("--pypi-jobs", help="number of simultaneous requests to the index to get the releases of the dependencies")
+@argh.arg("--pypi-cache-max-age", help="use the cached index responses younger than this number of seconds without "
+                                       "any request, older ones are revalidated")
+@argh.arg("--no-test-cache", help="always run the tests, even if they have already been run with the same "
+                                  "dependencies on the same revision")
+@argh.arg("--index-url", help="where to look for the releases: a pypi like json API, a PEP 503 simple index "
+                              "(ending with /simple, or /+simple for devpi) or a local directory mirror")
+@argh.arg("--resume", help="resume the last interrupted session: skip the dependencies already done and reuse "
+                           "its test results")
+@argh.arg("--optimistic", help="first try to upgrade all the dependencies to their latest version at once, then "
+                               "only search the highest working version of the ones breaking the tests")
+@argh.arg("--fail-fast", help="abort the tests as soon as their output shows a failure (pytest or unittest failure, "
+                              "import error...)")
+@argh.arg("--fail-pattern", action="append", help="abort the tests as soon as a line of their output matches this "
+                                                  "regex, can be repeated (implies --fail-fast)")
+@argh.arg("--test-timeout", type=float, help="abort the tests after this number of seconds, they are then failed")
+def autoupgradedependencies(test_command, strategy="bisect", jobs=1, no_test_cache=False, pypi_jobs=PYPI_JOBS,
+                            pypi_cache_max_age=PYPI_CACHE_MAX_AGE, index_url=PYPI_INDEX_URL, resume=False,
+                            optimistic=False, fail_fast=False, fail_pattern=None, test_timeout=None):
+    index_settings["url"] = index_url
+    session = None
+
+    if resume:
+        session = find_session_to_resume()
+
+        if session is None:
+            print("ERROR: there is no interrupted session to resume in %s/" % SESSIONS_PATH)
+            sys.exit(1)
+
+        print("Resume session %s" % session)
 
+        start = read_journal(session)[0]
+        if start.get("test_command") != test_command:
+            print("WARNING: the session was started with the test command '%s'" % start.get("test_command"))
 
-def autoupgradedependencies(test_command):
     if test_command.strip().startswith("tox") and "--recreate" not in test_command:
         print("WARNING: if you are using tox you very likely want to put '--recreate' in the command")
 
-    if len(subprocess.check_output(["hg", "diff"]).strip()) != 0:
-        print("ERROR: according to 'hg diff' repository is not clean, abort")
-        sys.exit(1)
-
     path = "."
     path = os.path.realpath(os.path.expanduser(path))
 
     pkginfo_path = find_pkginfo(path)
     print("Foudn __pkginfo__.py: %s" % pkginfo_path)
 
-    depends, red, red_depends = parse_pkginfo(pkginfo_path)
+    if len(_hg(["diff"]).strip()) != 0 and session:
+        # the repository was clean when the session started
+        print("Revert the changes left by the interrupted session")
+        revert_session_changes(pkginfo_path)
+
+    if len(_hg(["diff"]).strip()) != 0:
+        print("ERROR: according to 'hg diff' repository is not clean, abort")
+        if session:
+            print("Only the files written by the interrupted session have been reverted, "
+                  "commit or revert the other changes before resuming it")
+        sys.exit(1)
+
+    depends, pkginfo = parse_pkginfo(pkginfo_path)
+    initial_depends = dict(depends)
     cubes = [x for x in depends if x.startswith("cubicweb-")]
 
     print("")
@@ -661,18 +2421,22 @@ def autoupgradedependencies(test_command):
 
     print("")
 
-    depends = merge_depends_with_pypi_info(depends)
+    depends = merge_depends_with_pypi_info(depends, jobs=pypi_jobs, max_age=pypi_cache_max_age)
 
     print("")
 
     depends = filter_pkg_that_can_be_upgraded(depends)
 
-    if not depends:
+    # a resumed session still needs its summary
+    if not depends and not session:
         print("")
         print("Nothing to do, everything is up to date")
         sys.exit(0)
 
-    try_to_upgrade_dependencies(test_command, depends, pkginfo_path, red, red_depends)
+    try_to_upgrade_dependencies(test_command, depends, pkginfo_path, pkginfo, initial_depends, strategy=strategy,
+                                jobs=jobs, use_test_cache=not no_test_cache, session=session, optimistic=optimistic,
+                                failure_patterns=fail_pattern or (DEFAULT_FAILURE_PATTERNS if fail_fast else ()),
+                                test_timeout=test_timeout)
 
 
 def generate_secure_random():
@@ -768,11 +2532,20 @@ def generate_doc():
 functions = [generate_pyramid_ini, autoupgradedependencies, generate_doc, to_newstyle_cube]
 
 parser = argh.ArghParser()
+parser.add_argument("--trace", default=None, metavar="FILE",
+                    help="write the duration of each phase of the command in FILE in the chrome trace format")
 parser.add_commands(functions)
 
 
 def main():
-    parser.dispatch()
+    options = parser.parse_known_args()[0]
+
+    try:
+        with span(getattr(options, "function", main).__name__, "command"):
+            parser.dispatch()
+    finally:
+        if options.trace:
+            write_trace(options.trace)
 
 
 if __name__ == '__main__':
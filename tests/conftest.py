@@ -0,0 +1,5 @@
+import os
+import sys
+
+# cubetoolkit and all_cubes are top level modules of the repository
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), "..")))
@@ -0,0 +1,40 @@
+import json
+import multiprocessing
+
+import cubetoolkit
+
+
+def write_formats(cache_path, cube_name, version):
+    cubetoolkit.CACHE_PATH = cache_path
+    cubetoolkit.update_cube_formats_cache({cube_name: {version: True}})
+
+
+def test_update_cube_formats_cache_keeps_the_entries_of_other_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(cubetoolkit, "CACHE_PATH", str(tmp_path))
+    monkeypatch.setattr(cubetoolkit, "_cube_formats", {})
+
+    # written by another process
+    cubetoolkit.write_json_cache(cubetoolkit.CUBE_FORMATS_CACHE_NAME, {"file": {"1.0": False}})
+
+    cubetoolkit.update_cube_formats_cache({"file": {"2.0": True}, "comment": {"1.0": True}})
+
+    with open(str(tmp_path / cubetoolkit.CUBE_FORMATS_CACHE_NAME)) as f:
+        assert json.load(f) == {"file": {"1.0": False, "2.0": True}, "comment": {"1.0": True}}
+
+    assert cubetoolkit._cube_formats["file"] == {"1.0": False, "2.0": True}
+
+
+def test_update_cube_formats_cache_concurrently(tmp_path):
+    processes = [multiprocessing.Process(target=write_formats, args=(str(tmp_path), "cube%d" % (i % 4), "%d.0" % i))
+                 for i in range(16)]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join()
+
+    with open(str(tmp_path / cubetoolkit.CUBE_FORMATS_CACHE_NAME)) as f:
+        formats = json.load(f)
+
+    assert sum(len(versions) for versions in formats.values()) == 16
@@ -0,0 +1,88 @@
+import ast
+
+from cubetoolkit import _find_imported_cubes, _rewrite_cube_imports
+
+
+def rewrite(text, cube_name="file"):
+    result = _rewrite_cube_imports(text, cube_name)
+    # the rewritten file must still be valid python
+    ast.parse(result)
+    return result
+
+
+def test_from_cubes_x_import():
+    assert rewrite("from cubes.file.views import View\n") == "from cubicweb_file.views import View\n"
+
+
+def test_import_cubes_x_and_its_references():
+    assert rewrite("import cubes.file\ncubes.file.views.View()\n") == "import cubicweb_file\ncubicweb_file.views.View()\n"
+
+
+def test_other_cubes_and_similar_names_are_kept():
+    text = "from cubes.filed import x\nimport cubes.comment\nmycubes.file = 1\n"
+
+    assert rewrite(text) == text
+
+
+def test_from_cubes_import():
+    assert rewrite("from cubes import file\n") == "import cubicweb_file as file\n"
+    assert rewrite("from cubes import file as f\n") == "import cubicweb_file as f\n"
+
+
+def test_from_cubes_import_several_cubes():
+    assert rewrite("from cubes import comment, file\n") == "from cubes import comment\nimport cubicweb_file as file\n"
+
+
+def test_from_cubes_import_parenthesized():
+    text = "from cubes import (\n    comment,\n    file as f,\n)\n"
+
+    assert rewrite(text) == "from cubes import comment\nimport cubicweb_file as f\n"
+
+
+def test_from_cubes_import_backslash_continuation():
+    text = "from cubes import file, \\\n    comment\nx = 1\n"
+
+    assert _find_imported_cubes(text) == {"file", "comment"}
+    assert rewrite(text) == "from cubes import comment\nimport cubicweb_file as file\nx = 1\n"
+
+
+def test_indented_import():
+    text = "def f():\n    from cubes import file\n    return file\n"
+
+    assert rewrite(text) == "def f():\n    import cubicweb_file as file\n    return file\n"
+
+
+def test_find_imported_cubes():
+    text = "import os\nfrom cubes.file import x\nimport cubes.tag\nfrom cubes import comment as c  # comment\n"
+
+    assert _find_imported_cubes(text) == {"file", "tag", "comment"}
+
+
+def test_from_cubes_import_parenthesized_with_comments():
+    text = "from cubes import (\n    file,  # the file cube\n    comment,\n)\n"
+
+    assert _find_imported_cubes(text) == {"file", "comment"}
+    assert rewrite(text) == "from cubes import comment\nimport cubicweb_file as file\n"
+
+
+def test_from_cubes_import_comment_with_commas_and_parenthesis():
+    text = "from cubes import (file,  # c, d)\n comment)\n"
+
+    assert _find_imported_cubes(text) == {"file", "comment"}
+    assert rewrite(text) == "from cubes import comment\nimport cubicweb_file as file\n"
+
+
+def test_from_cubes_import_trailing_comment():
+    assert rewrite("from cubes import file  # comment\n") == "import cubicweb_file as file  # comment\n"
+
+
+def test_bare_import_cubes():
+    text = "import cubes\n\ncubes.file.views.View()\n"
+
+    assert rewrite(text) == "import cubes\nimport cubicweb_file\n\ncubicweb_file.views.View()\n"
+
+
+def test_bare_import_cubes_with_the_module_imported():
+    text = "import cubes\nimport cubes.file\n\ncubes.file.views.View()\n"
+
+    assert rewrite(text) == "import cubes\nimport cubicweb_file\n\ncubicweb_file.views.View()\n"
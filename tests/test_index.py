@@ -0,0 +1,48 @@
+import pytest
+
+import cubetoolkit
+
+from cubetoolkit import _parse_simple_index
+
+
+PAGE = """<!DOCTYPE html>
+<html>
+  <body>
+    <a href="../../packages/cubicweb-file-1.0.0.tar.gz#sha256=abc">cubicweb-file-1.0.0.tar.gz</a>
+    <a href="https://files.example.org/cubicweb_file-1.0.0-py3-none-any.whl">cubicweb_file-1.0.0-py3-none-any.whl</a>
+    <a href="/packages/cubicweb_file-2.0.0-py3-none-any.whl">cubicweb_file-2.0.0-py3-none-any.whl</a>
+    <a href="/packages/cubicweb-file-2.0.0.tar.gz">cubicweb-file-2.0.0.tar.gz</a>
+    <a href="/packages/cubicweb-file-2.1.0.tar.gz" data-yanked="">cubicweb-file-2.1.0.tar.gz</a>
+    <a href="/packages/other-3.0.0.tar.gz">other-3.0.0.tar.gz</a>
+  </body>
+</html>
+"""
+
+
+def test_parse_simple_index():
+    releases = _parse_simple_index(PAGE, "https://pypi.example.org/simple/cubicweb-file/", "cubicweb-file")["releases"]
+
+    assert sorted(releases) == ["1.0.0", "2.0.0"]
+
+    # sdists first, the urls are absolute and without their hash fragment
+    assert [x["packagetype"] for x in releases["1.0.0"]] == ["sdist", "bdist_wheel"]
+    assert releases["1.0.0"][0]["url"] == "https://pypi.example.org/packages/cubicweb-file-1.0.0.tar.gz"
+    assert releases["1.0.0"][1]["url"] == "https://files.example.org/cubicweb_file-1.0.0-py3-none-any.whl"
+    assert releases["2.0.0"][0]["filename"] == "cubicweb-file-2.0.0.tar.gz"
+
+
+@pytest.mark.parametrize("index_url", ["https://mirror.example.org/simple", "https://devpi.example.org/root/pypi/+simple/"])
+def test_simple_index_urls(index_url, monkeypatch):
+    requested = []
+
+    def get_cached_http_document(url, cache_name, pkg_name, max_age, is_json):
+        requested.append((url, is_json))
+        return PAGE
+
+    monkeypatch.setitem(cubetoolkit.index_settings, "url", index_url)
+    monkeypatch.setattr(cubetoolkit, "_get_cached_http_document", get_cached_http_document)
+
+    data = cubetoolkit.get_pypi_releases("cubicweb_file")
+
+    assert requested == [("%s/cubicweb-file/" % index_url.rstrip("/"), False)]
+    assert sorted(data["releases"]) == ["1.0.0", "2.0.0"]
@@ -0,0 +1,54 @@
+from cubetoolkit import _isolate_culprits
+
+
+def make_test(culprits, runs):
+    def test(keys):
+        runs.append(list(keys))
+        return {"success": not set(keys) & set(culprits), "log_file_name": "run%d.log" % len(runs)}
+
+    return test
+
+
+def test_everything_works():
+    runs = []
+
+    accepted, culprits, last_success = _isolate_culprits(["a", "b", "c", "d"], make_test([], runs))
+
+    assert accepted == ["a", "b", "c", "d"]
+    assert culprits == []
+    assert last_success["log_file_name"] == "run1.log"
+    assert len(runs) == 1
+
+
+def test_one_culprit():
+    runs = []
+
+    accepted, culprits, last_success = _isolate_culprits(["a", "b", "c", "d"], make_test(["c"], runs))
+
+    assert sorted(accepted) == ["a", "b", "d"]
+    assert culprits == ["c"]
+    # the second half isn't tested with the accepted first half, it's known to fail
+    assert runs == [["a", "b", "c", "d"], ["a", "b"], ["a", "b", "c"], ["a", "b", "d"]]
+    assert last_success["log_file_name"] == "run4.log"
+
+
+def test_several_culprits():
+    runs = []
+
+    accepted, culprits, last_success = _isolate_culprits(["a", "b", "c", "d", "e", "f", "g", "h"],
+                                                         make_test(["b", "g"], runs))
+
+    assert sorted(accepted) == ["a", "c", "d", "e", "f", "h"]
+    assert sorted(culprits) == ["b", "g"]
+    # the upgrades that will be committed have been tested all together
+    assert sorted(runs[int(last_success["log_file_name"][3:-4]) - 1]) == sorted(accepted)
+
+
+def test_everything_fails():
+    runs = []
+
+    accepted, culprits, last_success = _isolate_culprits(["a", "b", "c"], make_test(["a", "b", "c"], runs))
+
+    assert accepted == []
+    assert sorted(culprits) == ["a", "b", "c"]
+    assert last_success == {}
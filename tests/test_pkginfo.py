@@ -0,0 +1,105 @@
+import pytest
+
+from cubetoolkit import parse_pkginfo, render_pkginfo
+
+
+PKGINFO = """# -*- coding: utf-8 -*-
+# copyright 2018 Logilab, Société Anonyme
+\"\"\"cubicweb-café application packaging information\"\"\"
+
+modname = 'café'
+distname = "cubicweb-café"
+
+__depends__ = {
+    'cubicweb': '>= 3.24.0',  # the framework
+    "cubicweb-file": "== 1.0.0",
+    u'cubicweb-comment': u'== 2.0.0',
+    'six':   '>= 1.4.0',
+
+    # not released yet
+    'cubicweb-tag': None,
+}
+
+__recommends__ = {'cubicweb-comment': '>= 1.0'}
+"""
+
+
+def write(tmp_path, content):
+    path = tmp_path / "__pkginfo__.py"
+    path.write_bytes(content.encode("utf-8"))
+    return str(path)
+
+
+def test_parse_pkginfo(tmp_path):
+    depends, _ = parse_pkginfo(write(tmp_path, PKGINFO))
+
+    assert depends == {
+        "cubicweb": ">= 3.24.0",
+        "cubicweb-file": "== 1.0.0",
+        "cubicweb-comment": "== 2.0.0",
+        "six": ">= 1.4.0",
+        "cubicweb-tag": None,
+    }
+
+
+def test_render_unchanged_values_is_byte_identical(tmp_path):
+    depends, pkginfo = parse_pkginfo(write(tmp_path, PKGINFO))
+
+    assert render_pkginfo(pkginfo, depends) == PKGINFO
+
+
+def test_render_keeps_quotes_prefix_comments_and_layout(tmp_path):
+    depends, pkginfo = parse_pkginfo(write(tmp_path, PKGINFO))
+
+    depends["cubicweb"] = "== 3.26.0"
+    depends["cubicweb-file"] = "== 2.0.0"
+    depends["cubicweb-comment"] = "== 2.1.0"
+
+    assert render_pkginfo(pkginfo, depends) == (PKGINFO.replace("'>= 3.24.0'", "'== 3.26.0'")
+                                                        .replace('"== 1.0.0"', '"== 2.0.0"')
+                                                        .replace("u'== 2.0.0'", "u'== 2.1.0'"))
+
+
+def test_render_only_touches_depends(tmp_path):
+    depends, pkginfo = parse_pkginfo(write(tmp_path, PKGINFO))
+
+    depends["cubicweb-comment"] = "== 3.0.0"
+    result = render_pkginfo(pkginfo, depends)
+
+    assert "__recommends__ = {'cubicweb-comment': '>= 1.0'}" in result
+    assert "Société Anonyme" in result
+
+
+def test_render_from_the_original_source(tmp_path):
+    """ Rendering several times doesn't accumulate the changes of previous
+    renderings, only the values of depends are used. """
+    depends, pkginfo = parse_pkginfo(write(tmp_path, PKGINFO))
+
+    render_pkginfo(pkginfo, dict(depends, six="== 1.10.0"))
+
+    assert render_pkginfo(pkginfo, dict(depends, cubicweb="== 3.25.0")) == PKGINFO.replace(">= 3.24.0", "== 3.25.0")
+
+
+def test_non_literal_values(tmp_path, capsys):
+    path = write(tmp_path, "VERSION = '1.0'\n__depends__ = {'cubicweb': '>= %s' % VERSION}\n")
+
+    with pytest.raises(SystemExit):
+        parse_pkginfo(path)
+
+    assert "non literal values" in capsys.readouterr().out
+
+
+def test_depends_is_not_a_dict(tmp_path, capsys):
+    path = write(tmp_path, "__depends__ = dict(cubicweb='>= 3.24.0')\n")
+
+    with pytest.raises(SystemExit):
+        parse_pkginfo(path)
+
+    assert "isn't a dict" in capsys.readouterr().out
+
+
+def test_no_depends(tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        parse_pkginfo(write(tmp_path, "modname = 'file'\n"))
+
+    assert "couldn't find __depends__" in capsys.readouterr().out
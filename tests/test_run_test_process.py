@@ -0,0 +1,21 @@
+import time
+
+import cubetoolkit
+
+
+def test_timeout(tmp_path):
+    return_code, reason = cubetoolkit.run_test_process("sleep 10", str(tmp_path / "log"), timeout=0.5)
+
+    assert return_code != 0
+    assert reason == "timeout after 0.5s"
+
+
+def test_tests_ignoring_sigterm_are_killed(tmp_path, monkeypatch):
+    monkeypatch.setattr(cubetoolkit, "KILL_GRACE_PERIOD", 0.5)
+    start = time.time()
+
+    return_code, reason = cubetoolkit.run_test_process('trap "" TERM; sleep 10', str(tmp_path / "log"), timeout=0.5)
+
+    assert return_code != 0
+    assert reason == "timeout after 0.5s"
+    assert time.time() - start < 5
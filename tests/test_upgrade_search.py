@@ -0,0 +1,62 @@
+from cubetoolkit import _update_search_range, _pick_versions_to_test, _test_outcome_key
+
+
+def results(**outcomes):
+    return {int(index[1:]): {"success": success} for index, success in outcomes.items()}
+
+
+def test_latest_version_works():
+    assert _update_search_range(results(i9=True), None, 0, 8, 9) == (9, 10, 8)
+
+
+def test_failure_limits_the_range():
+    assert _update_search_range(results(i9=False), None, 0, 8, 9) == (None, 0, 8)
+    assert _update_search_range(results(i4=False), None, 0, 8, 9) == (None, 0, 3)
+
+
+def test_success_after_a_failure_is_ignored():
+    # a version after a failing one is assumed to fail too
+    assert _update_search_range(results(i3=False, i6=True), None, 0, 8, 9) == (None, 0, 2)
+
+
+def test_highest_success_before_the_first_failure():
+    assert _update_search_range(results(i2=True, i4=True, i6=False), None, 0, 8, 9) == (4, 5, 5)
+
+
+def test_cancelled_tests_are_ignored():
+    assert _update_search_range(results(i2=True, i4=None), None, 0, 8, 9) == (2, 3, 8)
+
+
+def test_best_is_kept_from_previous_rounds():
+    assert _update_search_range(results(i5=False), 3, 4, 8, 9) == (3, 4, 4)
+
+
+def test_bisect_until_the_highest_working_version():
+    # versions up to index 5 work, find it like try_to_upgrade_dependencies
+    latest = 9
+    best, lowest, highest = None, 0, latest - 1
+    indexes = [latest]
+    tested = []
+
+    while indexes:
+        tested.extend(indexes)
+        best, lowest, highest = _update_search_range(dict((i, {"success": i <= 5}) for i in indexes),
+                                                     best, lowest, highest, latest)
+        indexes = _pick_versions_to_test(lowest, highest, 1, "bisect")
+
+    assert best == 5
+    assert len(tested) <= 5
+
+
+def test_pick_versions_to_test():
+    assert _pick_versions_to_test(0, 8, 1, "bisect") == [4]
+    assert _pick_versions_to_test(0, 8, 2, "linear") == [0, 1]
+    assert _pick_versions_to_test(5, 4, 1, "bisect") == []
+
+
+def test_test_outcome_key_doesnt_depend_on_the_order_of_depends():
+    key = _test_outcome_key({"a": "== 1", "b": "== 2"}, "node", "tox")
+
+    assert key == _test_outcome_key({"b": "== 2", "a": "== 1"}, "node", "tox")
+    assert key != _test_outcome_key({"a": "== 1", "b": "== 3"}, "node", "tox")
+    assert key != _test_outcome_key({"a": "== 1", "b": "== 2"}, "other node", "tox")
@@ -0,0 +1,36 @@
+from cubetoolkit import build_version_index, find_maximum_compatible_version, parse_conditions
+
+
+def index(*versions):
+    return build_version_index([{"version": x} for x in versions])
+
+
+def maximum(keys, all_versions, scheme):
+    result = find_maximum_compatible_version(keys, parse_conditions(scheme))
+    return None if result is None else all_versions[result]["version"]
+
+
+def test_build_version_index_sorts_following_pep_440():
+    keys, all_versions = index("1.10.0", "1.9.0", "1.2.0rc1", "1.2.0", "not a version")
+
+    assert [x["version"] for x in all_versions] == ["1.2.0rc1", "1.2.0", "1.9.0", "1.10.0"]
+    assert keys == sorted(keys)
+
+
+def test_find_maximum_compatible_version():
+    keys, all_versions = index("1.0", "1.2.3", "1.9.0", "1.10.0", "2.0")
+
+    assert maximum(keys, all_versions, "== 1.9.0") == "1.9.0"
+    assert maximum(keys, all_versions, "== 1.9") == "1.9.0"
+    assert maximum(keys, all_versions, ">= 1.0, < 2.0") == "1.10.0"
+    assert maximum(keys, all_versions, "<= 1.2.3") == "1.2.3"
+    assert maximum(keys, all_versions, "> 1.0, != 1.10.0, < 2.0") == "1.9.0"
+    assert maximum(keys, all_versions, "> 2.0") is None
+    assert maximum(keys, all_versions, "== 1.5") is None
+
+
+def test_pre_releases_only_if_nothing_else_matches():
+    keys, all_versions = index("1.0", "2.0b1")
+
+    assert maximum(keys, all_versions, ">= 1.0") == "1.0"
+    assert maximum(keys, all_versions, ">= 2.0b1") == "2.0b1"